@@ -0,0 +1,144 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import threading
+import time
+
+from metrics import run_metrics
+from utilities import HostLimitedAdapter
+
+# Airtable rejects more than 5 requests per second per base and then locks the client out for 30 seconds.
+# The limit is per base, not per process, so every process using the same AIRTABLE_RATE_LIMIT_FILE (by default
+# the working directory's) takes its request slots from one shared schedule: a daemon and an overlapping one-shot
+# run stay under the limit together. Processes on other boxes writing to the same base can't see that file, so
+# give each box its share of the rate instead (e.g. AIRTABLE_REQUESTS_PER_SECOND=2.5 on each of two boxes), or
+# keep to one writing box per base.
+requests_per_second = float(os.environ.get('AIRTABLE_REQUESTS_PER_SECOND', 5))
+rate_limit_path = os.environ.get('AIRTABLE_RATE_LIMIT_FILE', '.airtable_rate_limit.json')
+# Requests spaced exactly at the limit still trip the rolling one second window when one arrives a few ms early,
+# and each trip costs the 30 second lockout, so the bucket runs slightly under the limit
+rate_headroom = 0.1
+rate_limited_pause = 30
+max_rate_limited_retries = 3
+max_requests_in_flight = 5
+
+
+class TokenBucket:
+    # One request slot every 1 / rate seconds, so requests are spaced evenly instead of bursting after an idle spell
+    def __init__(self, rate=requests_per_second, path=rate_limit_path):
+        self.rate = rate
+        self.path = path
+        self.lock_path = '{}.lock'.format(path)
+        self.thread_lock = threading.Lock()
+
+    @contextmanager
+    def locked(self):
+        # The thread lock covers threads of this process, flock covers other processes
+        with self.thread_lock, open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_state(self):
+        try:
+            with open(self.path) as state_file:
+                return json.load(state_file)
+        except (FileNotFoundError, ValueError):
+            return dict(next_slot_at=0, paused_until=0)
+
+    def write_state(self, state_dict):
+        temporary_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(temporary_path, 'w') as state_file:
+            json.dump(state_dict, state_file)
+        os.replace(temporary_path, self.path)
+
+    def reserve(self):
+        with self.locked():
+            state_dict = self.read_state()
+            slot_at = max(time.time(), state_dict['next_slot_at'], state_dict['paused_until'])
+            state_dict['next_slot_at'] = slot_at + 1 / self.rate
+            self.write_state(state_dict)
+        return slot_at
+
+    def is_paused(self):
+        with self.locked():
+            return self.read_state()['paused_until'] > time.time()
+
+    def acquire(self):
+        waited = 0
+        while True:
+            wait = self.reserve() - time.time()
+            if wait > 0:
+                time.sleep(wait)
+                waited += wait
+            # A 429 in any process may have paused the bucket while this request waited for its slot
+            if not self.is_paused():
+                return waited
+
+    def pause(self, seconds):
+        with self.locked():
+            state_dict = self.read_state()
+            state_dict['paused_until'] = max(state_dict['paused_until'], time.time() + seconds)
+            self.write_state(state_dict)
+
+
+airtable_token_bucket = TokenBucket(requests_per_second * (1 - rate_headroom))
+
+
+class RateLimitedAdapter(HostLimitedAdapter):
+    def __init__(self, token_bucket=airtable_token_bucket, max_retries=max_rate_limited_retries, **kwargs):
+        self.token_bucket = token_bucket
+        self.max_rate_limited_retries = max_retries
+        super().__init__(**kwargs)
+
+    def get_rate_limited_pause(self, response, attempt):
+        retry_after = response.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            return int(retry_after)
+        return rate_limited_pause * 2 ** attempt
+
+    def send(self, request, **kwargs):
+        attempt = 0
+        while True:
+            run_metrics.add(self.carrier, 'throttled_seconds', self.token_bucket.acquire())
+            response = super().send(request, **kwargs)
+            if response.status_code != 429 or attempt >= self.max_rate_limited_retries:
+                return response
+
+            # Every thread shares the bucket, so pausing it holds back all Airtable traffic, not just this request
+            run_metrics.add(self.carrier, 'rate_limited')
+            self.token_bucket.pause(self.get_rate_limited_pause(response, attempt))
+            response.close()
+            attempt += 1
+
+
+class AirtableWriter:
+    def __init__(self, max_in_flight=max_requests_in_flight):
+        # Senders block on the token bucket, so with a few of them there is always a request ready to go out
+        # the moment the next token is available, instead of waiting on the previous response
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='airtable')
+
+    def submit(self, write, *args, **kwargs):
+        return self.executor.submit(write, *args, **kwargs)
+
+
+def get_budget_dict(started_at, finished_at=None, rate=requests_per_second):
+    finished_at = finished_at or time.time()
+    airtable_metrics = run_metrics.get_summary_dict()['carriers'].get('airtable', {})
+    budget = max(finished_at - started_at, 1) * rate
+    return dict(requests=airtable_metrics.get('requests', 0),
+                budget=budget,
+                budget_used=airtable_metrics.get('requests', 0) / budget,
+                throttled_seconds=airtable_metrics.get('throttled_seconds', 0),
+                rate_limited=airtable_metrics.get('rate_limited', 0))
+
+
+def report_budget(started_at):
+    budget_dict = get_budget_dict(started_at)
+    run_metrics.add('airtable', 'budget_used', budget_dict['budget_used'])
+    print('Airtable: {requests:.0f} requests, {budget_used:.0%} of the {budget:.0f} request budget, '
+          '{throttled_seconds:.1f}s throttled, {rate_limited:.0f} rate limited'.format(**budget_dict))
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import threading
+import time
+
+import aiohttp
+from yarl import URL
+
+from metrics import run_metrics
+from utilities import default_request_timeout, per_host_connection_limit
+
+# The HTTP carriers (BNSF, CN, CSX, NS, UP) trace on one event loop: their requests are coroutines on aiohttp
+# sessions sharing one connector, so PER_HOST_CONNECTION_LIMIT holds across carriers, and a carrier past its timeout
+# is cancelled mid request. Blocking jobs, CP's session and browser flow, get a daemon thread each.
+
+
+class Response:
+    # The parts of a requests response the scrapers read, with the body already read so the connection goes back
+    # to the pool straight away
+    def __init__(self, status_code, content, url):
+        self.status_code = status_code
+        self.content = content
+        self.url = url
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def get_connector():
+    return aiohttp.TCPConnector(limit=0, limit_per_host=per_host_connection_limit)
+
+
+class CarrierClient:
+    def __init__(self, carrier='all', connector=None, timeout=default_request_timeout):
+        self.carrier = carrier
+        self.connector = connector
+        self.timeout = timeout
+        self.session = None
+
+    async def __aenter__(self):
+        # unsafe so cookies from hosts given by IP address are kept, as requests keeps them
+        self.session = aiohttp.ClientSession(connector=self.connector or get_connector(),
+                                             connector_owner=self.connector is None,
+                                             timeout=aiohttp.ClientTimeout(total=self.timeout),
+                                             cookie_jar=aiohttp.CookieJar(unsafe=True))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def request(self, method, url, **kwargs):
+        started_at = time.perf_counter()
+        async with self.session.request(method, url, **kwargs) as response:
+            content = await response.read()
+        run_metrics.add(self.carrier, 'bytes_received', len(content))
+        run_metrics.add(self.carrier, 'request_seconds', time.perf_counter() - started_at)
+        run_metrics.add(self.carrier, 'requests')
+        if response.status >= 400:
+            run_metrics.add(self.carrier, 'request_errors')
+        return Response(response.status, content, str(response.url))
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    def update_cookies(self, cookies_dict, url):
+        self.session.cookie_jar.update_cookies(cookies_dict, URL(url))
+
+
+def run_with_client(carrier, fetch):
+    # For the sync scraper methods: fetch(client) on an event loop and client of its own
+    async def run():
+        async with CarrierClient(carrier) as client:
+            return await fetch(client)
+    return asyncio.run(run())
+
+
+async def gather_limited(coroutines, max_in_flight):
+    # Results in order, like executor.map, with at most max_in_flight of the coroutines running at once
+    slots = asyncio.Semaphore(max_in_flight)
+
+    async def run(coroutine):
+        async with slots:
+            return await coroutine
+    return await asyncio.gather(*[run(coroutine) for coroutine in coroutines])
+
+
+def set_future_result(future, result, error):
+    if future.done():
+        return
+    if error:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+def run_in_daemon_thread(function, *args):
+    # Unlike run_in_executor's threads, which are joined at exit, an abandoned daemon thread can't keep the process
+    # alive; a blocking call has no way to be cancelled
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def run():
+        result, error = None, None
+        try:
+            result = function(*args)
+        except Exception as e:
+            error = e
+        try:
+            loop.call_soon_threadsafe(set_future_result, future, result, error)
+        except RuntimeError:
+            # The loop is closed: the job was abandoned at its timeout and nobody is waiting for it
+            pass
+
+    threading.Thread(target=run, name=getattr(function, '__name__', 'job'), daemon=True).start()
+    return future
+
+
+async def run_carrier_job(carrier, job, connector):
+    # (results, error); coroutine jobs are called with a client on the shared connector
+    try:
+        if asyncio.iscoroutinefunction(job):
+            async with CarrierClient(carrier, connector) as client:
+                return await job(client), None
+        return await run_in_daemon_thread(job), None
+    except Exception as e:
+        return None, e
+
+
+async def extract_carriers(carrier_jobs_dict, timeouts_dict=None, default_timeout=300):
+    # Yields (carrier, results, error) as carriers finish; a carrier past its timeout is cancelled and yielded
+    # with a TimeoutError
+    timeouts_dict = timeouts_dict or {}
+    connector = get_connector()
+    carriers_dict = {}
+    for carrier, job in carrier_jobs_dict.items():
+        task = asyncio.ensure_future(asyncio.wait_for(run_carrier_job(carrier, job, connector),
+                                                      timeouts_dict.get(carrier, default_timeout)))
+        carriers_dict[task] = carrier
+
+    try:
+        pending_tasks = set(carriers_dict)
+        while pending_tasks:
+            finished_tasks, pending_tasks = await asyncio.wait(pending_tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished_tasks:
+                carrier = carriers_dict[task]
+                if task.exception():
+                    results, error = None, TimeoutError('timed out after {} seconds'.format(
+                        timeouts_dict.get(carrier, default_timeout)))
+                else:
+                    results, error = task.result()
+                yield carrier, results, error
+    finally:
+        # Carriers still running when the caller stops listening are cancelled with their requests
+        for task in carriers_dict:
+            task.cancel()
+        await asyncio.gather(*carriers_dict, return_exceptions=True)
+        await connector.close()
@@ -0,0 +1,138 @@
+import argparse
+from itertools import cycle, islice
+import json
+import os
+import re
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+from cn_parser import parse_tracing_results
+from scrapers import bnsf_rows_strainer, cp_results_strainer
+from transform import BNSFTransform, CanadianNationalTransform, CanadianPacificTransform, \
+    CSXTransform, NorfolkSouthernTransform, UnionPacificTransform
+
+fixtures_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+bnsf_row_pattern = re.compile(r'<tr id="dllRowStyle">.*?</tr>', re.S)
+cp_row_pattern = re.compile(r'<tr><td>[A-Z]{4}[0-9]{7}</td>.*?</tr>', re.S)
+cn_header_lines_count = 5
+default_sizes = [10, 1000, 50000]
+
+
+def read_fixture(file_name, mode='r'):
+    with open(os.path.join(fixtures_path, file_name), mode) as fixture_file:
+        return fixture_file.read()
+
+
+def get_containers_list(units_count):
+    return ['TEST{:06d}0'.format(i) for i in range(units_count)]
+
+
+def scale_html_rows(html, row_pattern, units_count):
+    # Repeat the recorded rows until the page holds units_count of them
+    rows = row_pattern.findall(html)
+    rows_start = html.index(rows[0])
+    rows_end = html.rindex(rows[-1]) + len(rows[-1])
+    return html[:rows_start] + '\n'.join(islice(cycle(rows), units_count)) + html[rows_end:]
+
+
+def scale_cn_response(content, units_count):
+    lines = content.split(b'\r\n')
+    header_lines, rows, footer_lines = lines[:cn_header_lines_count], lines[cn_header_lines_count:-2], lines[-2:]
+    return b'\r\n'.join(header_lines + list(islice(cycle(rows), units_count)) + footer_lines)
+
+
+def prepare_bnsf(units_count, parser, use_strainer):
+    html = scale_html_rows(read_fixture('bnsf.html'), bnsf_row_pattern, units_count)
+    containers_list = get_containers_list(units_count)
+    parse_only = bnsf_rows_strainer if use_strainer else None
+    return lambda: BNSFTransform(BeautifulSoup(html, parser, parse_only=parse_only),
+                                 containers_list).get_tracing_result_list()
+
+
+def prepare_cp(units_count, parser, use_strainer):
+    html = scale_html_rows(read_fixture('cp.html'), cp_row_pattern, units_count)
+    containers_list = get_containers_list(units_count)
+    parse_only = cp_results_strainer if use_strainer else None
+    return lambda: CanadianPacificTransform(BeautifulSoup(html, parser, parse_only=parse_only),
+                                            containers_list, {}).get_tracing_results_list()
+
+
+def prepare_cn(units_count, parser, use_strainer):
+    location_content = scale_cn_response(read_fixture('cn_hl.html', 'rb'), units_count)
+    eta_content = scale_cn_response(read_fixture('cn_hh.html', 'rb'), units_count)
+    containers_list = get_containers_list(units_count)
+    return lambda: CanadianNationalTransform(parse_tracing_results(location_content, eta_content,
+                                                                   containers_list)).get_tracing_results_list()
+
+
+def prepare_csx(units_count, parser, use_strainer):
+    recorded_results = json.loads(read_fixture('csx.json'))
+    raw_results_list = []
+    for i, recorded_result in enumerate(islice(cycle(recorded_results), units_count)):
+        raw_result = dict(recorded_result)
+        raw_result['equipment'] = {'equipmentID': {'equipmentInitial': 'TEST', 'equipmentNumber': '{:06d}'.format(i)}}
+        raw_results_list.append(raw_result)
+    containers_dict = {container[:-1]: container for container in get_containers_list(units_count)}
+    return lambda: CSXTransform(raw_results_list, containers_dict, {}).get_tracing_results_list()
+
+
+def prepare_up(units_count, parser, use_strainer):
+    raw_results_list = list(islice(cycle(json.loads(read_fixture('up.json'))), units_count))
+    containers_list = get_containers_list(units_count)
+    return lambda: UnionPacificTransform(raw_results_list, containers_list).get_tracing_results_list()
+
+
+def prepare_ns(units_count, parser, use_strainer):
+    raw_results_dict = dict(zip(get_containers_list(units_count), cycle(json.loads(read_fixture('ns.json')))))
+    return lambda: NorfolkSouthernTransform(raw_results_dict).get_tracing_results_list()
+
+
+carriers_dict = {
+    'bnsf': prepare_bnsf,
+    'cn': prepare_cn,
+    'cp': prepare_cp,
+    'csx': prepare_csx,
+    'ns': prepare_ns,
+    'up': prepare_up,
+}
+html_carriers = ('bnsf', 'cp')
+
+
+def measure(run):
+    # Timed and memory-traced separately, tracemalloc would skew the timing
+    started_at, cpu_started_at = time.perf_counter(), time.process_time()
+    results = run()
+    elapsed, cpu_seconds = time.perf_counter() - started_at, time.process_time() - cpu_started_at
+
+    tracemalloc.start()
+    run()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return len(results), elapsed, cpu_seconds, peak_memory
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description='Benchmark the carrier transforms on recorded fixtures')
+    argument_parser.add_argument('--carriers', default=','.join(carriers_dict))
+    argument_parser.add_argument('--sizes', default=','.join(str(size) for size in default_sizes))
+    argument_parser.add_argument('--parsers', default='lxml', help='HTML parsers to compare for BNSF and CP')
+    argument_parser.add_argument('--no-strainer', action='store_true')
+    arguments = argument_parser.parse_args()
+
+    print('{:<5} {:<12} {:>7} {:>7} {:>9} {:>9} {:>11} {:>9}'.format('', 'parser', 'units', 'rows', 'seconds',
+                                                                    'cpu s', 'rows/s', 'peak MB'))
+    for carrier in arguments.carriers.split(','):
+        parsers = arguments.parsers.split(',') if carrier in html_carriers else ['-']
+        for units_count in [int(size) for size in arguments.sizes.split(',')]:
+            for parser in parsers:
+                run = carriers_dict[carrier](units_count, parser, not arguments.no_strainer)
+                rows_count, elapsed, cpu_seconds, peak_memory = measure(run)
+                print('{:<5} {:<12} {:>7} {:>7} {:>9.3f} {:>9.3f} {:>11.0f} {:>9.1f}'.format(
+                    carrier, parser, units_count, rows_count, elapsed, cpu_seconds, rows_count / elapsed,
+                    peak_memory / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
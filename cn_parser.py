@@ -0,0 +1,39 @@
+from collections import namedtuple
+import html
+import re
+
+# Rows start after the report header, same offset the lxml text extraction used
+header_lines_count = 5
+prologue_pattern = re.compile(rb'^\s*(?:(?:<!DOCTYPE[^>]*>|<!--.*?-->|<\?.*?\?>)\s*)*', re.S | re.I)
+tag_pattern = re.compile(rb'<!--.*?-->|<[^>]*>', re.S)
+
+CanadianNationalRecord = namedtuple('CanadianNationalRecord', ['most_recent_location', 'next_destination',
+                                                               'rail_status_key', 'event_datetime', 'eta_token'])
+
+
+def get_response_rows(content, rows_count):
+    # Same lines BeautifulSoup(content, 'lxml').text would give, without building a tree
+    content = prologue_pattern.sub(b'', content).replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+    lines = tag_pattern.sub(b'', content).split(b'\n')[header_lines_count:header_lines_count + rows_count]
+    return [html.unescape(line.decode('utf-8', 'replace')) for line in lines]
+
+
+def parse_record(location_row, eta_row):
+    location_tokens = location_row.split()
+    most_recent_location = ', '.join(location_tokens[2:4])
+    if 'RECORD' in most_recent_location:
+        return CanadianNationalRecord(most_recent_location, None, None, None, None)
+
+    eta_tokens = eta_row.split()
+    return CanadianNationalRecord(most_recent_location=most_recent_location,
+                                  next_destination=', '.join(location_tokens[9:11]),
+                                  rail_status_key=location_tokens[7],
+                                  event_datetime=''.join(location_tokens[4:6]),
+                                  eta_token=eta_tokens[-1] if eta_tokens else '')
+
+
+def parse_tracing_results(location_content, eta_content, containers_list):
+    location_rows = get_response_rows(location_content, len(containers_list))
+    eta_rows = get_response_rows(eta_content, len(containers_list))
+    return {container: parse_record(location_row, eta_row)
+            for container, location_row, eta_row in zip(dict.fromkeys(containers_list), location_rows, eta_rows)}
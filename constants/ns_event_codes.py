@@ -169,4 +169,7 @@ event_codes = {
     'XFRO': 'TYES TRANSFER OUT OF INVENTORY',
     'YDEN': 'YARD END (TYES -- CREW OFF)',
     'YDST': 'YARD START (TYES -- CREW ON)',
-}
\ No newline at end of file
+}
+
+# Events after which a unit is sitting at the ramp waiting for pickup
+grounded_event_codes = {'AVPL', 'CONF', 'DRMP', 'NOPA', 'NOTE', 'NOTF', 'NOTV', 'NTFY', 'PACT', 'PCON'}
@@ -1,69 +1,230 @@
 from collections import defaultdict
-import json
+from functools import lru_cache
+import posixpath
+import threading
+import time
 
 from airtable import Airtable
-
-data_sources = json.load(open('data_config.json'))['data_sources']['airtable']
-airtable_containers_sheet = Airtable(data_sources['base_key'], 'Containers', data_sources['api_key'])
-
-
-def get_containers_from_db(view_name):
-    containers_by_view_dict = defaultdict(list)
-
+from requests.exceptions import RequestException
+
+from airtable_client import AirtableWriter, RateLimitedAdapter
+from metrics import run_metrics
+from utilities import get_data_sources
+
+max_records_per_request = Airtable.MAX_RECORDS_PER_REQUEST
+# The daemon never restarts, so record ids and Final Destinations are reloaded once they are this old
+container_index_ttl = 60 * 60
+# What a batch update gets back when one of its records was deleted or re-created
+stale_record_status_codes = (404, 422)
+
+
+@lru_cache(maxsize=None)
+def get_containers_sheet():
+    data_source = get_data_sources()['airtable']
+    containers_sheet = Airtable(data_source['base_key'], 'Containers', data_source['api_key'])
+    if 'api_url' in data_source:
+        # e.g. the local stand-in used by load_test.py
+        containers_sheet.url_table = posixpath.join(data_source['api_url'], data_source['base_key'], 'Containers')
+    # Every Airtable request is counted, timed and rate limited under carrier="airtable", so the wrapper's
+    # own sleep between pages is not needed
+    adapter = RateLimitedAdapter(carrier='airtable')
+    containers_sheet.session.mount('https://', adapter)
+    containers_sheet.session.mount('http://', adapter)
+    containers_sheet.API_LIMIT = 0
+    return containers_sheet
+
+
+class ContainerIndex:
+    fields = ['Container', 'MBL', 'Final Destination', 'Container Yard']
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.records_dict = {}
+        self.snapshot_records_dict = {}
+        self.loaded_at = None
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+
+    def is_stale(self):
+        if self.loaded_at is None:
+            return True
+        return self.ttl is not None and time.monotonic() - self.loaded_at > self.ttl
+
+    def load(self):
+        airtable_records = get_containers_sheet().get_all(fields=self.fields)
+        records_dict = {}
+        for record in airtable_records:
+            if 'Container' in record['fields']:
+                records_dict[record['fields']['Container']] = record
+        with self.lock:
+            self.records_dict = records_dict
+            self.loaded_at = time.monotonic()
+
+    def set_snapshot_records(self, snapshot_records_dict):
+        # Record ids and final destinations already known from the view snapshot (see
+        # view_sync.ViewSnapshot.get_records_dict), so the load stage doesn't need the whole table loaded
+        with self.lock:
+            self.snapshot_records_dict = snapshot_records_dict
+
+    def invalidate(self, container_number=None):
+        with self.lock:
+            if container_number is None:
+                self.loaded_at = None
+            else:
+                self.records_dict.pop(container_number, None)
+                self.snapshot_records_dict.pop(container_number, None)
+
+    def get(self, container_number):
+        if self.is_stale():
+            with self.load_lock:
+                if self.is_stale():
+                    self.load()
+        if container_number in self.records_dict:
+            return self.records_dict[container_number]
+        # Containers created after the index was built fall back to a single search. A miss is kept as None, so a
+        # container missing from Airtable costs one search until the next reload or invalidate(), not one per lookup
+        records = get_containers_sheet().search('Container', container_number, fields=self.fields)
+        record = records[0] if records else None
+        with self.lock:
+            self.records_dict[container_number] = record
+        return record
+
+    def get_record_id(self, container_number):
+        if container_number in self.snapshot_records_dict:
+            return self.snapshot_records_dict[container_number][0]
+        record = self.get(container_number)
+        if record:
+            return record['id']
+
+    def get_final_destination(self, container_number):
+        if container_number in self.snapshot_records_dict:
+            return self.snapshot_records_dict[container_number][1]
+        record = self.get(container_number)
+        try:
+            return record['fields']['Final Destination'][0]
+        except (KeyError, TypeError):
+            return
+
+
+container_index = ContainerIndex(ttl=container_index_ttl)
+airtable_writer = AirtableWriter()
+
+
+view_fields_dict = {
+    'Pending ANs': ['Container', 'MBL'],
+    'Tracing View': ['Container', 'Container Yard', 'MBL', 'Final Destination'],
+}
+
+
+def get_view_entry(view_name, fields):
+    # (container, group key, MBL) for a record, grouped by MBL prefix or Container Yard depending on the view
+    container = fields.get('Container')
+    mbl = fields['MBL'][0] if fields.get('MBL') else None
     if view_name == 'Pending ANs':
-        airtable_records = airtable_containers_sheet.get_all(
-            fields=['Container', 'MBL'],
-            view=view_name
-        )
+        group_key = mbl[:4] if mbl else None
+    else:
+        group_key = fields['Container Yard'][0] if fields.get('Container Yard') else None
+    if container and group_key:
+        return container, group_key, mbl
 
-        for record in airtable_records:
-            container = record['fields']['Container']
-            containers_by_view_dict[record['fields']['MBL'][0][:4]].append(container)
 
-    elif view_name == 'Tracing View':
-        airtable_records = airtable_containers_sheet.get_all(fields=['Container', 'Container Yard'], view=view_name)
-        for record in airtable_records:
-            container = record['fields']['Container']
-            containers_by_view_dict[record['fields']['Container Yard'][0]].append(container)
+def get_containers_from_db(view_name, include_mbl=False, snapshot=None):
+    containers_by_view_dict = defaultdict(list)
+    mbls_by_container_dict = {}
 
+    if snapshot:
+        # Incremental mode: only records changed since the last sync are pulled, see view_sync.ViewSnapshot
+        view_entries = snapshot.sync()
+        container_index.set_snapshot_records(snapshot.get_records_dict())
+    else:
+        airtable_records = get_containers_sheet().get_all(fields=view_fields_dict[view_name], view=view_name)
+        view_entries = [get_view_entry(view_name, record['fields']) for record in airtable_records]
+
+    for view_entry in view_entries:
+        if view_entry:
+            container, group_key, mbl = view_entry
+            if mbl:
+                mbls_by_container_dict[container] = mbl
+            containers_by_view_dict[group_key].append(container)
+
+    if include_mbl:
+        return containers_by_view_dict, mbls_by_container_dict
     return containers_by_view_dict
 
 
 def update_container_tracing(container_number, tracing_results, tracing_type=('rail', 'ssl')):
-    record = airtable_containers_sheet.search('Container', container_number)
+    record = container_index.get(container_number)
 
     if 'rail' in tracing_type:
         fields = {'Rail Tracing': tracing_results}
     else:
         fields = {'SSL Tracing': tracing_results}
 
-    airtable_containers_sheet.update(record[0]['id'], fields)
+    get_containers_sheet().update(record['id'], fields)
 
 
 def update_container_lfd(container_number, lfd):
-    record = airtable_containers_sheet.search('Container', container_number)
+    record = container_index.get(container_number)
     fields = {'LFD': lfd}
-    airtable_containers_sheet.update(record[0]['id'], fields)
+    get_containers_sheet().update(record['id'], fields)
 
 
 def update_container_eta(container_number, eta, eta_type=('rail', 'ssl')):
-    record = airtable_containers_sheet.search('Container', container_number)
+    record = container_index.get(container_number)
     if 'rail' in eta_type:
         fields = {'Rail ETA': eta}
     else:
         fields = {'Vessel ETA': eta}
-    airtable_containers_sheet.update(record[0]['id'], fields)
+    get_containers_sheet().update(record['id'], fields)
+
+
+def update_containers(fields_by_container_dict, carrier='all'):
+    # One PATCH per 10 records instead of a search + update per field
+    records = []
+    container_numbers_list = []
+    for container_number, fields in fields_by_container_dict.items():
+        record_id = container_index.get_record_id(container_number)
+        if record_id:
+            records.append(dict(id=record_id, fields=fields))
+            container_numbers_list.append(container_number)
+        else:
+            print('Container not found in Airtable: {}'.format(container_number))
+
+    # Chunks are sent concurrently at Airtable's rate limit and collected in order
+    pending_writes = []
+    for i in range(0, len(records), max_records_per_request):
+        run_metrics.add(carrier, 'airtable_calls')
+        pending_writes.append((container_numbers_list[i:i + max_records_per_request],
+                               airtable_writer.submit(get_containers_sheet().batch_update,
+                                                      records[i:i + max_records_per_request])))
+
+    updated_containers_list = []
+    for chunk_containers_list, pending_write in pending_writes:
+        try:
+            pending_write.result()
+            updated_containers_list += chunk_containers_list
+        except RequestException as e:
+            # Per chunk, so a connection error or timeout on one doesn't lose the chunks already written
+            run_metrics.add(carrier, 'airtable_errors')
+            print(e)
+            if e.response is not None and e.response.status_code in stale_record_status_codes:
+                # Looked up again next time instead of failing the same 10 records every cycle
+                for container_number in chunk_containers_list:
+                    container_index.invalidate(container_number)
+
+    run_metrics.add(carrier, 'containers_written', len(updated_containers_list))
+
+    return updated_containers_list
 
 
 def get_mbl_from_container(container_number):
-    record = airtable_containers_sheet.search('Container', container_number)
-    return record[0]['fields']['MBL'][0]
+    record = container_index.get(container_number)
+    return record['fields']['MBL'][0]
 
 
 def get_final_destination(container_number):
-    record = airtable_containers_sheet.search('Container', container_number)
-    try:
-        return record[0]['fields']['Final Destination'][0]
-    except KeyError:
-        return
+    return container_index.get_final_destination(container_number)
+
 
+def get_final_destinations_dict(containers_list):
+    return {container_number: get_final_destination(container_number) for container_number in containers_list}
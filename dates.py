@@ -0,0 +1,79 @@
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+
+# Every carrier's ETA and last free day are written in this one format
+output_date_format = '%Y-%m-%d'
+dates_cache_size = 4096
+
+
+class RunClock:
+    # One timestamp per run, so every record from a run carries the same time and datetime.now() isn't paid per row
+    def __init__(self):
+        self.start()
+
+    def start(self, timestamp=None):
+        # Shard workers start from the coordinator's timestamp, so a sharded run is still stamped with one time
+        self.timestamp = timestamp or datetime.now()
+        self.year = self.timestamp.year
+        self.today = self.timestamp.date()
+
+
+run_clock = RunClock()
+
+
+@lru_cache(maxsize=dates_cache_size)
+def parse_date(value):
+    # Slicing fast paths for the two layouts carriers send, ISO and MM/DD/YYYY, either optionally followed by a
+    # time; anything else comes back as None
+    if not value:
+        return None
+    try:
+        if value[4:5] == '-' and value[7:8] == '-':
+            return date(int(value[:4]), int(value[5:7]), int(value[8:10]))
+        elif value[2:3] == '/' and value[5:6] == '/':
+            return date(int(value[6:10]), int(value[:2]), int(value[3:5]))
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=dates_cache_size)
+def format_date(value, date_format=output_date_format):
+    return value.strftime(date_format)
+
+
+def normalize_date(value):
+    # Unparseable values (e.g. CN's blank ETA) are passed through untouched
+    parsed_date = parse_date(value)
+    if parsed_date:
+        return format_date(parsed_date)
+    return value
+
+
+def shift_date(value, days):
+    parsed_date = parse_date(value)
+    if parsed_date:
+        return format_date(parsed_date + timedelta(days=days))
+
+
+@lru_cache(maxsize=dates_cache_size)
+def parse_month_day(value, year):
+    # MMDD tokens carry no year, so the run's year is assumed
+    try:
+        return date(year, int(value[:2]), int(value[2:4]))
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=dates_cache_size)
+def parse_month_day_time(value, year):
+    # MMDDHHMM
+    try:
+        return datetime(year, int(value[:2]), int(value[2:4]), int(value[4:6]), int(value[6:8]))
+    except ValueError:
+        return None
+
+
+def get_days_until(value, today=None):
+    parsed_date = parse_date(value)
+    if parsed_date:
+        return (parsed_date - (today or run_clock.today)).days
@@ -0,0 +1,33 @@
+import asyncio
+
+from async_extract import extract_carriers
+from metrics import run_metrics
+
+
+def run_carrier_jobs(carrier_jobs_dict, timeouts_dict=None, default_timeout=300, on_failure=None):
+    # Every carrier on one event loop, see async_extract. The loop runs while this generator waits for the next
+    # carrier to finish, so callers should be quick with each one. A blocking job can't be cancelled and is
+    # abandoned at its timeout; on_failure(carrier) lets the caller stop accepting its rows.
+    loop = asyncio.new_event_loop()
+    finished_carriers = extract_carriers(carrier_jobs_dict, timeouts_dict, default_timeout)
+    try:
+        while True:
+            try:
+                carrier, results, error = loop.run_until_complete(finished_carriers.__anext__())
+            except StopAsyncIteration:
+                return
+            if error:
+                report_failure(carrier, error, on_failure)
+            else:
+                yield carrier, results
+    finally:
+        loop.run_until_complete(finished_carriers.aclose())
+        loop.run_until_complete(loop.shutdown_default_executor())
+        loop.close()
+
+
+def report_failure(carrier, error, on_failure=None):
+    if on_failure:
+        on_failure(carrier)
+    run_metrics.add(carrier, 'failures')
+    print('{} failed: {!r}'.format(carrier, error))
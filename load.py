@@ -0,0 +1,78 @@
+from collections import defaultdict
+
+from database import update_containers
+from metrics import run_metrics
+from tracing_result import TracingStatus
+
+
+def get_pending_fields(result):
+    return {'Rail Tracing': 'Pending\nTimestamp: {}'.format(result.timestamp)}
+
+
+def get_outgated_fields(result):
+    return {'Rail Tracing': 'Most Recent Event: {}\nTimestamp: {}'.format(result.most_recent_event, result.timestamp)}
+
+
+def get_grounded_fields(result):
+    fields = {'Rail Tracing': 'Most Recent Event: {}\nTimestamp: {}'.format(result.most_recent_event,
+                                                                            result.timestamp)}
+    if result.last_free_day:
+        fields['LFD'] = result.last_free_day
+    return fields
+
+
+def get_grounding_fields(result):
+    return {'Rail Tracing': 'Most Recent Event: {}\nTimestamp: {}'.format(result.most_recent_event, result.timestamp),
+            'Rail ETA': result.eta}
+
+
+def get_on_route_fields(result):
+    tracing_result = 'Most Recent Event: {}\nScheduled Event: {}\nTimestamp: {}'.format(result.most_recent_event,
+                                                                                       result.scheduled_event,
+                                                                                       result.timestamp)
+    return {'Rail Tracing': tracing_result, 'Rail ETA': result.eta}
+
+
+# Unknown results (the carrier response was missing the fields we classify on) are not written
+fields_by_status_dict = {
+    TracingStatus.PENDING: get_pending_fields,
+    TracingStatus.OUTGATED: get_outgated_fields,
+    TracingStatus.GROUNDED: get_grounded_fields,
+    TracingStatus.GROUNDING: get_grounding_fields,
+    TracingStatus.ON_ROUTE: get_on_route_fields,
+}
+
+
+def get_container_fields(result):
+    get_fields = fields_by_status_dict.get(result.current_status)
+    if get_fields:
+        return get_fields(result)
+
+
+def get_fields_by_container_dict(tracing_results):
+    # Merge every field change for a container into a single record patch
+    fields_by_container_dict = defaultdict(dict)
+    for result in tracing_results:
+        fields = get_container_fields(result)
+        if fields:
+            fields_by_container_dict[result.container_number].update(fields)
+    return fields_by_container_dict
+
+
+def load_tracing_results(tracing_results, state_store=None, carrier='all', poll_schedule=None):
+    changed_results = state_store.get_changed_results(tracing_results) if state_store else tracing_results
+
+    fields_by_container_dict = get_fields_by_container_dict(changed_results)
+    with run_metrics.timer(carrier, 'load_seconds'):
+        updated_containers_list = update_containers(fields_by_container_dict, carrier)
+
+    updated_containers_set = set(updated_containers_list)
+    if state_store:
+        state_store.save_results([result for result in changed_results
+                                  if result.container_number in updated_containers_set])
+    if poll_schedule:
+        # Containers whose write failed keep their old poll time, so they are retried next cycle
+        failed_containers_set = set(fields_by_container_dict) - updated_containers_set
+        poll_schedule.save_results([result for result in tracing_results
+                                    if result.container_number not in failed_containers_set])
+    return updated_containers_list
@@ -0,0 +1,98 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from stand_ins import StandIns
+
+package_path = os.path.dirname(os.path.abspath(__file__))
+default_sizes = [100, 1000, 10000, 100000]
+
+
+def get_counts_delta_dict(counts_dict, previous_counts_dict):
+    return {name: {key: value - previous_counts_dict[name][key] for key, value in counts.items()}
+            for name, counts in counts_dict.items()}
+
+
+def run_main(run_dir, environment, options_list):
+    started_at = time.perf_counter()
+    with open(os.path.join(run_dir, 'main.log'), 'w') as log_file:
+        completed = subprocess.run([sys.executable, os.path.join(package_path, 'main.py')] + options_list,
+                                   cwd=run_dir, env=environment, stdout=log_file, stderr=subprocess.STDOUT)
+    elapsed = time.perf_counter() - started_at
+
+    if completed.returncode != 0:
+        with open(os.path.join(run_dir, 'main.log')) as log_file:
+            print(log_file.read()[-4000:])
+    with open(os.path.join(run_dir, 'run_summary.json')) as summary_file:
+        return elapsed, json.load(summary_file)['carriers']
+
+
+def run_pipeline(containers_count, arguments):
+    # [(pass name, seconds, run summary carriers, stand-in counts)]: a full sync, then an incremental one after
+    # arguments.changes records were added and as many moved
+    stand_ins = StandIns(containers_count, arguments.latency, arguments.error_rate, arguments.airtable_rate_limit)
+    try:
+        with open(os.path.join(package_path, 'data_config.json')) as config_file:
+            data_config = stand_ins.get_data_config(json.load(config_file))
+
+        # main.py runs in a scratch directory so its config, token cache, state and metrics are the load test's own
+        with tempfile.TemporaryDirectory(prefix='raileggs-load-') as run_dir:
+            with open(os.path.join(run_dir, 'data_config.json'), 'w') as config_file:
+                json.dump(data_config, config_file)
+            environment = dict(os.environ,
+                               AIRTABLE_REQUESTS_PER_SECOND=str(arguments.airtable_rate_limit),
+                               CARRIER_TIMEOUT_SECONDS=str(arguments.carrier_timeout),
+                               METRICS_DIR=run_dir)
+
+            options_list = [] if arguments.workers is None else ['--workers', str(arguments.workers)]
+
+            passes_list = []
+            elapsed, carriers_dict = run_main(run_dir, environment, ['--full-sync'] + options_list)
+            passes_list.append(('full', elapsed, carriers_dict, stand_ins.get_counts_dict()))
+
+            stand_ins.airtable.change_records(arguments.changes)
+            elapsed, carriers_dict = run_main(run_dir, environment, options_list)
+            counts_dict = stand_ins.get_counts_dict()
+            passes_list.append(('incremental', elapsed, carriers_dict,
+                                get_counts_delta_dict(counts_dict, passes_list[-1][3])))
+        return passes_list
+    finally:
+        stand_ins.stop()
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description='Run main.py end to end against local stand-in servers')
+    argument_parser.add_argument('--sizes', default=','.join(str(size) for size in default_sizes))
+    argument_parser.add_argument('--latency', type=float, default=0.05, help='mean seconds added to every response')
+    argument_parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 503')
+    argument_parser.add_argument('--airtable-rate-limit', type=float, default=5,
+                                 help='requests per second the Airtable stand-in accepts (and the client is told)')
+    argument_parser.add_argument('--carrier-timeout', type=int, default=24 * 60 * 60)
+    argument_parser.add_argument('--workers', type=int, help='run main.py sharded across this many worker processes')
+    argument_parser.add_argument('--changes', type=int, default=10,
+                                 help='records added, and as many moved to another yard, before the incremental pass')
+    arguments = argument_parser.parse_args()
+
+    print('{:>7} {:<11} {:>9} {:>12} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+        'units', 'pass', 'seconds', 'containers/s', 'rows', 'written', 'airtable', '429s', 'errors'))
+    for containers_count in [int(size) for size in arguments.sizes.split(',')]:
+        for pass_name, elapsed, carriers_dict, counts_dict in run_pipeline(containers_count, arguments):
+            rows_count = sum(metrics.get('rows', 0) for metrics in carriers_dict.values())
+            errors_count = sum(counts['errors'] for counts in counts_dict.values())
+            print('{:>7} {:<11} {:>9.1f} {:>12.1f} {:>7.0f} {:>9} {:>9} {:>9} {:>9}'.format(
+                containers_count, pass_name, elapsed, rows_count / elapsed, rows_count,
+                counts_dict['airtable']['records_written'], counts_dict['airtable']['requests'],
+                counts_dict['airtable']['rate_limited'], errors_count))
+            for carrier, metrics in sorted(carriers_dict.items()):
+                if 'rows' in metrics:
+                    print('{:>7} {:<5} {:>6.0f} rows, extract {:.1f}s, transform {:.1f}s, load {:.1f}s'.format(
+                        '', carrier, metrics['rows'], metrics.get('extract_seconds', 0),
+                        metrics.get('transform_seconds', 0), metrics.get('load_seconds', 0)))
+
+
+if __name__ == '__main__':
+    main()
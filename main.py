@@ -1,64 +1,340 @@
-from database import update_container_tracing, update_container_eta, update_container_lfd
+import argparse
+from collections import defaultdict
+from datetime import datetime
+from functools import partial
+import multiprocessing
+import os
+import socket
+import time
+import uuid
+
+from airtable_client import report_budget
+from async_extract import run_in_daemon_thread
+from database import get_containers_from_db, get_final_destinations_dict
+from dates import run_clock
+from extract import run_carrier_jobs
+from metrics import run_metrics
+from pipeline import LoadWorker, ResultsBuffer, ResultsStream
+from scheduler import PollSchedule
+from shards import LeaseKeeper, ShardQueue, split_into_shards
 from scrapers import BNSFScraper, CanadianNationalScraper, CanadianPacificScraper, \
-    CSXScraper, UnionPacificScraper
+    CSXScraper, NorfolkSouthernScraper, UnionPacificScraper
+from state import TracingStateStore
+from tracing_result import TracingResult
 from transform import BNSFTransform, CanadianNationalTransform, CanadianPacificTransform, \
-    CSXTransform, UnionPacificTransform
-
-# EXTRACT
-bnsf = BNSFScraper()
-cn = CanadianNationalScraper()
-cp = CanadianPacificScraper()
-csx = CSXScraper()
-up = UnionPacificScraper()
-
-# TRANSFORM
-bnsf_transform = BNSFTransform(bnsf.get_tracing_results_html(), bnsf.containers_list)
-cn_transform = CanadianNationalTransform(cn.get_tracing_results_dict())
-cp_transform = CanadianPacificTransform(cp.get_tracing_results_html(), cp.containers_list)
-csx_transform = CSXTransform(csx.get_tracing_results_list(), csx.get_containers_dict())
-up_transform = UnionPacificTransform(up.get_tracing_results_dict(), up.containers_list)
-
-# LOAD
-cn_transformed_results = cn_transform.get_tracing_results_list()
-bnsf_transformed_results = bnsf_transform.get_tracing_result_list()
-cp_transformed_results = cp_transform.get_tracing_results_list()
-csx_transformed_results = csx_transform.get_tracing_results_list()
-up_transformed_results = up_transform.get_tracing_results_list()
-
-tracing_results = bnsf_transformed_results + cn_transformed_results + \
-                  cp_transformed_results + csx_transformed_results + up_transformed_results
-
-
-for result in tracing_results:
-    if 'Pending' in result['current_status']:
-        update_container_tracing(result['container_number'],
-                                 'Pending\nTimestamp: {}'.format(result['timestamp']),
-                                 'rail')
-
-    elif 'Outgated' in result['current_status']:
-        update_container_tracing(result['container_number'],
-                                 'Most Recent Event: {}\nTimestamp: {}'.format(result['most_recent_event'],
-                                                                               result['timestamp']))
-    elif 'Grounded' in result['current_status']:
-        tracing_result = 'Most Recent Event: {}\nTimestamp: {}'.format(result['most_recent_event'],
-                                                                               result['timestamp'])
-        update_container_tracing(result['container_number'], tracing_result, 'rail')
+    CSXTransform, NorfolkSouthernTransform, UnionPacificTransform
+from utilities import get_carrier_from_yard
+from view_sync import ViewSnapshot
+
+
+def stream_rows(carrier, transform, raw_tracing_results, results_stream):
+    # Each row goes to the load worker as soon as it is built; time blocked on a full stream is not transform time
+    tracing_results = transform(raw_tracing_results)
+    rows_count, transform_seconds = 0, 0
+    while True:
+        started_at = time.perf_counter()
+        tracing_result = next(tracing_results, None)
+        transform_seconds += time.perf_counter() - started_at
+        if tracing_result is None or not results_stream.put(carrier, tracing_result):
+            break
+        rows_count += 1
+
+    run_metrics.add(carrier, 'transform_seconds', transform_seconds)
+    run_metrics.add(carrier, 'rows', rows_count)
+    return rows_count
+
+
+def run_stages(carrier, extract, transform, results_stream):
+    with run_metrics.timer(carrier, 'extract_seconds'):
+        raw_tracing_results = extract()
+    return stream_rows(carrier, transform, raw_tracing_results, results_stream)
+
+
+async def run_stages_async(carrier, extract, transform, results_stream):
+    with run_metrics.timer(carrier, 'extract_seconds'):
+        raw_tracing_results = await extract()
+    # Off the event loop, since a full stream blocks until the load stage catches up
+    return await run_in_daemon_thread(stream_rows, carrier, transform, raw_tracing_results, results_stream)
+
+
+# EXTRACT + TRANSFORM, one job per carrier; the HTTP carriers' jobs are coroutines given a client by the engine
+async def trace_bnsf(containers_list, results_stream, client):
+    bnsf = BNSFScraper(containers_list)
+    return await run_stages_async('BNSF', partial(bnsf.fetch_tracing_results, client),
+                                  lambda html: BNSFTransform(html, bnsf.containers_list).iter_tracing_results(),
+                                  results_stream)
+
+
+async def trace_cn(containers_list, results_stream, client):
+    cn = CanadianNationalScraper(containers_list)
+    return await run_stages_async('CN', partial(cn.fetch_tracing_results, client),
+                                  lambda records: CanadianNationalTransform(records).iter_tracing_results(),
+                                  results_stream)
+
+
+def trace_cp(containers_list, results_stream, final_destinations_dict=None):
+    cp = CanadianPacificScraper(containers_list)
+    if final_destinations_dict is None:
+        final_destinations_dict = get_final_destinations_dict(cp.containers_list)
+    return run_stages('CP', cp.get_tracing_results_html,
+                      lambda html: CanadianPacificTransform(html, cp.containers_list,
+                                                            final_destinations_dict).iter_tracing_results(),
+                      results_stream)
+
+
+async def trace_csx(containers_by_yard_dict, mbls_by_container_dict, results_stream, final_destinations_dict,
+                    client):
+    csx = CSXScraper(containers_by_yard_dict, mbls_by_container_dict)
+    containers_dict = csx.get_containers_dict()
+    if final_destinations_dict is None:
+        # Airtable lookups block, so they run off the event loop
+        final_destinations_dict = await run_in_daemon_thread(get_final_destinations_dict, containers_dict.values())
+    return await run_stages_async('CSX', partial(csx.fetch_tracing_results, client),
+                                  lambda results: CSXTransform(results, containers_dict,
+                                                               final_destinations_dict).iter_tracing_results(),
+                                  results_stream)
+
+
+async def trace_ns(containers_list, results_stream, client):
+    ns = NorfolkSouthernScraper(containers_list)
+    return await run_stages_async('NS', partial(ns.fetch_tracing_results, client),
+                                  lambda results: NorfolkSouthernTransform(results or {}).iter_tracing_results(),
+                                  results_stream)
+
+
+async def trace_up(containers_list, results_stream, client):
+    up = UnionPacificScraper(containers_list)
+    return await run_stages_async('UP', partial(up.fetch_tracing_results, client),
+                                  lambda results: UnionPacificTransform(results,
+                                                                        up.containers_list).iter_tracing_results(),
+                                  results_stream)
+
+
+def get_carrier_jobs_dict(containers_by_yard_dict, mbls_by_container_dict, results_stream,
+                          final_destinations_dict=None):
+    carriers_set = {get_carrier_from_yard(yard) for yard, containers_list in containers_by_yard_dict.items()
+                    if containers_list}
+    carrier_jobs_dict = {
+        'BNSF': partial(trace_bnsf, containers_by_yard_dict['BNSF'], results_stream),
+        'CN': partial(trace_cn, containers_by_yard_dict['CN'], results_stream),
+        'CP': partial(trace_cp, containers_by_yard_dict['CP'], results_stream, final_destinations_dict),
+        'CSX': partial(trace_csx, containers_by_yard_dict, mbls_by_container_dict, results_stream,
+                       final_destinations_dict),
+        'NS': partial(trace_ns, containers_by_yard_dict['NORFOLK SOUTHERN'], results_stream),
+        'UP': partial(trace_up, containers_by_yard_dict['UP'], results_stream),
+    }
+    return {carrier: job for carrier, job in carrier_jobs_dict.items() if carrier in carriers_set}
+
+
+carrier_timeouts_dict = {'CP': 600}
+default_carrier_timeout = int(os.environ.get('CARRIER_TIMEOUT_SECONDS', 300))
+
+
+shard_carriers_needing_destinations = ('CP', 'CSX')
+shard_poll_seconds = 1
+
+
+def run_shard(carrier, payload):
+    # EXTRACT + TRANSFORM for one shard inside a worker, returning its rows and the worker's metrics for them
+    run_clock.start(datetime.fromisoformat(payload['run_timestamp']))
+    run_metrics.reset()
+    results_buffer = ResultsBuffer()
+    carrier_jobs_dict = get_carrier_jobs_dict(defaultdict(list, payload['containers_by_yard']),
+                                              payload['mbls_by_container'], results_buffer,
+                                              payload['final_destinations'])
+    finished_carriers = [finished_carrier for finished_carrier, rows_count in
+                         run_carrier_jobs(carrier_jobs_dict, carrier_timeouts_dict, default_carrier_timeout)]
+    if carrier not in finished_carriers:
+        # Partial rows are dropped; the shard goes back on the queue and is traced again in full
+        raise RuntimeError('{} job failed'.format(carrier))
+    return dict(results=[tracing_result.to_dict() for tracing_result in results_buffer.results_list],
+                metrics=run_metrics.get_summary_dict()['carriers'])
+
+
+def get_worker_id(pid):
+    return '{}:{}'.format(socket.gethostname(), pid)
+
+
+def run_worker(shard_queue_path, stopped=None):
+    shard_queue = ShardQueue(shard_queue_path)
+    worker_id = get_worker_id(os.getpid())
+    while not (stopped and stopped.is_set()):
+        shard = shard_queue.lease(worker_id)
+        if shard is None:
+            time.sleep(shard_poll_seconds)
+            continue
+
+        shard_id, lease_id, carrier, payload = shard
+        lease_keeper = LeaseKeeper(shard_queue, shard_id, lease_id)
+        lease_keeper.start()
         try:
-            update_container_lfd(result['container_number'], result['last_free_day'])
-        except KeyError:
-            print(result)
-    elif 'Grounding' in result['current_status']:
-        tracing_result = 'Most Recent Event: {}\nTimestamp: {}'.format(result['most_recent_event'],
-                                                                       result['timestamp'])
-        update_container_tracing(result['container_number'], tracing_result, 'rail')
-        update_container_eta(result['container_number'], result['eta'], 'rail')
-    else:
-        tracing_result = 'Most Recent Event: {}\nScheduled Event: {}\nTimestamp: {}'.format(result['most_recent_event'],
-                                                                                            result['scheduled_event'],
-                                                                                            result['timestamp'])
+            output = run_shard(carrier, payload)
+        except Exception as e:
+            print('{} shard {} failed: {!r}'.format(carrier, shard_id, e))
+            shard_queue.release(shard_id, lease_id, repr(e))
+            continue
+        finally:
+            lease_keeper.stop()
+        if not shard_queue.complete(shard_id, lease_id, output):
+            print('{} shard {} was taken over by another worker, dropping its results'.format(carrier, shard_id))
+
+
+def get_shards_list(containers_by_yard_dict, mbls_by_container_dict, shard_size):
+    shards_list = []
+    for carrier, shard_containers_by_yard_dict in split_into_shards(containers_by_yard_dict, shard_size):
+        containers_list = [container for containers in shard_containers_by_yard_dict.values()
+                           for container in containers]
+        # Looked up here so workers never touch Airtable, whose rate limit only one process can keep to
+        final_destinations_dict = {}
+        if carrier in shard_carriers_needing_destinations:
+            final_destinations_dict = get_final_destinations_dict(containers_list)
+        shards_list.append((carrier, dict(run_timestamp=run_clock.timestamp.isoformat(),
+                                          containers_by_yard=shard_containers_by_yard_dict,
+                                          mbls_by_container={container: mbls_by_container_dict[container]
+                                                             for container in containers_list
+                                                             if container in mbls_by_container_dict},
+                                          final_destinations=final_destinations_dict)))
+    return shards_list
+
+
+def start_shard_worker(shard_queue_path, stopped, worker_number):
+    # spawn, not fork: the load and extract threads are already running and a forked child would inherit their locks
+    worker = multiprocessing.get_context('spawn').Process(target=run_worker, args=(shard_queue_path, stopped),
+                                                          name='shard-worker-{}'.format(worker_number), daemon=True)
+    worker.start()
+    return worker
+
+
+def run_shards(containers_by_yard_dict, mbls_by_container_dict, results_stream, shard_queue, workers_count):
+    # Coordinator: EXTRACT + TRANSFORM run in shard workers and their rows come back to this process's one load stage
+    run_id = uuid.uuid4().hex
+    shard_queue.enqueue_run(run_id, get_shards_list(containers_by_yard_dict, mbls_by_container_dict,
+                                                    shard_queue.shard_size))
+
+    # Local workers live for the run; workers started with --worker, here or on other boxes, keep polling the queue
+    stopped = multiprocessing.get_context('spawn').Event()
+    workers_list = [start_shard_worker(shard_queue.path, stopped, i) for i in range(workers_count)]
+    try:
+        while True:
+            for carrier, output in shard_queue.take_finished_shards(run_id):
+                for result_dict in output['results']:
+                    results_stream.put(carrier, TracingResult.from_dict(result_dict))
+                for metrics_carrier, metrics in output['metrics'].items():
+                    for name, value in metrics.items():
+                        run_metrics.add(metrics_carrier, name, value)
+                print('{} shard streamed {} rows'.format(carrier, len(output['results'])))
+
+            shard_queue.heartbeat(run_id)
+            shard_queue.fail_expired_shards(run_id)
+            if shard_queue.is_run_finished(run_id):
+                break
+
+            for i, worker in enumerate(workers_list):
+                if not worker.is_alive():
+                    print('{} exited with code {}, starting a replacement'.format(worker.name, worker.exitcode))
+                    shard_queue.expire_leases(get_worker_id(worker.pid))
+                    run_metrics.add('all', 'workers_restarted')
+                    workers_list[i] = start_shard_worker(shard_queue.path, stopped, i)
+            time.sleep(shard_poll_seconds)
+    finally:
+        stopped.set()
+        for worker in workers_list:
+            worker.join(shard_poll_seconds * 5)
+            if worker.is_alive():
+                worker.terminate()
+
+    counts_dict = shard_queue.get_run_counts_dict(run_id)
+    shard_queue.finish_run(run_id)
+    shards_count = sum(counts_dict.get(status, 0) for status in ('delivered', 'failed'))
+    run_metrics.add('all', 'shards', shards_count)
+    run_metrics.add('all', 'shards_failed', counts_dict.get('failed', 0))
+    run_metrics.add('all', 'shard_retries', counts_dict['attempts'] - shards_count)
+
+
+def run_cycle(containers_by_yard_dict, mbls_by_container_dict, state_store, poll_schedule, shard_queue=None,
+              workers_count=0):
+    run_clock.start()
+
+    # LOAD runs alongside EXTRACT + TRANSFORM, writing each carrier's rows while slower carriers are still scraping
+    results_stream = ResultsStream()
+    load_worker = LoadWorker(results_stream, state_store, poll_schedule)
+    load_worker.start()
+
+    with run_metrics.timer('all', 'extract_stage_seconds'):
+        if shard_queue:
+            run_shards(containers_by_yard_dict, mbls_by_container_dict, results_stream, shard_queue, workers_count)
+        else:
+            carrier_jobs_dict = get_carrier_jobs_dict(containers_by_yard_dict, mbls_by_container_dict, results_stream)
+            for carrier, rows_count in run_carrier_jobs(carrier_jobs_dict, carrier_timeouts_dict,
+                                                        default_carrier_timeout, results_stream.cancel):
+                print('{} streamed {} rows'.format(carrier, rows_count))
+
+    with run_metrics.timer('all', 'load_stage_seconds'):
+        load_worker.finish()
+
+    report_budget(run_metrics.started_at)
+    run_metrics.write()
+
+
+def run_daemon(cycle_seconds, snapshot, shard_queue=None, workers_count=0):
+    # Only containers whose next poll time has passed are traced; see scheduler.get_poll_interval
+    state_store = TracingStateStore()
+    poll_schedule = PollSchedule()
+    while True:
+        started_at = time.time()
+        run_metrics.reset()
         try:
-            update_container_tracing(result['container_number'], tracing_result, 'rail')
-            update_container_eta(result['container_number'], result['eta'], 'rail')
-        except TypeError:
-            print(result)
+            containers_by_yard_dict, mbls_by_container_dict = get_containers_from_db('Tracing View', include_mbl=True,
+                                                                                     snapshot=snapshot)
+            due_containers_by_yard_dict = poll_schedule.get_due_containers_by_yard(containers_by_yard_dict)
+            for yard, containers_list in containers_by_yard_dict.items():
+                carrier = get_carrier_from_yard(yard)
+                due_count = len(due_containers_by_yard_dict.get(yard, []))
+                run_metrics.add(carrier, 'containers_due', due_count)
+                run_metrics.add(carrier, 'containers_skipped', len(containers_list) - due_count)
+
+            if due_containers_by_yard_dict:
+                run_cycle(due_containers_by_yard_dict, mbls_by_container_dict, state_store, poll_schedule,
+                          shard_queue, workers_count)
+            else:
+                run_metrics.write()
+        except Exception as e:
+            print('Polling cycle failed: {!r}'.format(e))
+        time.sleep(max(0, cycle_seconds - (time.time() - started_at)))
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description='Trace rail containers and load the results into Airtable')
+    argument_parser.add_argument('--daemon', action='store_true', help='keep polling containers as they fall due')
+    argument_parser.add_argument('--cycle-seconds', type=int, default=300)
+    argument_parser.add_argument('--full-sync', action='store_true',
+                                 help='pull the whole view instead of the records changed since the last sync, '
+                                      'also when airtable.view_filter_fields is missing')
+    argument_parser.add_argument('--workers', type=int,
+                                 help='shard extract + transform across this many worker processes '
+                                      '(0 leaves the shards to --worker processes started elsewhere)')
+    argument_parser.add_argument('--worker', action='store_true',
+                                 help='only trace shards from --shard-queue for a coordinator running elsewhere')
+    argument_parser.add_argument('--shard-queue', default='tracing_shards.sqlite3')
+    argument_parser.add_argument('--shard-size', type=int, default=500)
+    arguments = argument_parser.parse_args()
+
+    if arguments.worker:
+        run_worker(arguments.shard_queue)
+        return
+
+    shard_queue = None
+    if arguments.workers is not None:
+        shard_queue = ShardQueue(arguments.shard_queue, shard_size=arguments.shard_size)
+    snapshot = ViewSnapshot('Tracing View', full_sync_after=0) if arguments.full_sync else ViewSnapshot('Tracing View')
+    if arguments.daemon:
+        run_daemon(arguments.cycle_seconds, snapshot, shard_queue, arguments.workers)
+    else:
+        containers_by_yard_dict, mbls_by_container_dict = get_containers_from_db('Tracing View', include_mbl=True,
+                                                                                 snapshot=snapshot)
+        run_cycle(containers_by_yard_dict, mbls_by_container_dict, TracingStateStore(), PollSchedule(), shard_queue,
+                  arguments.workers)
+
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+metrics_prefix = 'raileggs'
+
+
+class RunMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics_dict = defaultdict(lambda: defaultdict(float))
+        self.started_at = time.time()
+
+    def reset(self):
+        with self.lock:
+            self.metrics_dict.clear()
+            self.started_at = time.time()
+
+    def add(self, carrier, name, value=1):
+        with self.lock:
+            self.metrics_dict[carrier][name] += value
+
+    @contextmanager
+    def timer(self, carrier, name):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(carrier, name, time.perf_counter() - started_at)
+
+    def get_summary_dict(self):
+        with self.lock:
+            carriers_dict = {carrier: dict(metrics) for carrier, metrics in self.metrics_dict.items()}
+        return dict(started_at=self.started_at, finished_at=time.time(), carriers=carriers_dict)
+
+    @staticmethod
+    def write_atomically(path, text):
+        # The node_exporter textfile collector may read at any moment, so never leave a partial file
+        temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary_path, 'w') as output_file:
+            output_file.write(text)
+        os.replace(temporary_path, path)
+
+    def write_prometheus(self, path):
+        summary_dict = self.get_summary_dict()
+        names = sorted({name for metrics in summary_dict['carriers'].values() for name in metrics})
+        lines = []
+        for name in names:
+            lines.append('# TYPE {}_{} gauge'.format(metrics_prefix, name))
+            for carrier, metrics in sorted(summary_dict['carriers'].items()):
+                if name in metrics:
+                    lines.append('{}_{}{{carrier="{}"}} {}'.format(metrics_prefix, name, carrier, metrics[name]))
+        lines.append('# TYPE {}_last_run_timestamp_seconds gauge'.format(metrics_prefix))
+        lines.append('{}_last_run_timestamp_seconds {}'.format(metrics_prefix, summary_dict['finished_at']))
+        self.write_atomically(path, '\n'.join(lines) + '\n')
+
+    def write_json(self, path):
+        self.write_atomically(path, json.dumps(self.get_summary_dict(), indent=2, sort_keys=True))
+
+    def write(self, metrics_dir=None):
+        metrics_dir = metrics_dir or os.environ.get('METRICS_DIR', '.')
+        self.write_prometheus(os.path.join(metrics_dir, '{}.prom'.format(metrics_prefix)))
+        self.write_json(os.path.join(metrics_dir, 'run_summary.json'))
+
+
+run_metrics = RunMetrics()
@@ -0,0 +1,91 @@
+from collections import defaultdict
+import queue
+import threading
+
+from load import load_tracing_results
+from metrics import run_metrics
+
+
+class ResultsStream:
+    def __init__(self, maxsize=1000):
+        # Bounded so a carrier that transforms faster than Airtable accepts writes waits instead of piling up rows
+        self.results_queue = queue.Queue(maxsize=maxsize)
+        self.closed = threading.Event()
+        self.cancelled_carriers = set()
+
+    def put(self, carrier, tracing_result):
+        while not self.closed.is_set() and carrier not in self.cancelled_carriers:
+            try:
+                self.results_queue.put((carrier, tracing_result), timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, timeout):
+        return self.results_queue.get(timeout=timeout)
+
+    def is_drained(self):
+        return self.closed.is_set() and self.results_queue.empty()
+
+    def cancel(self, carrier):
+        # For a carrier reported as failed or timed out: rows it already streamed are loaded, later ones are dropped
+        self.cancelled_carriers.add(carrier)
+
+    def close(self):
+        # Carriers still running after close have their results dropped
+        self.closed.set()
+
+
+class ResultsBuffer:
+    # Same put() as ResultsStream, for shard workers that hand a shard's rows back all at once
+    def __init__(self):
+        self.results_list = []
+
+    def put(self, carrier, tracing_result):
+        self.results_list.append(tracing_result)
+        return True
+
+
+class LoadWorker(threading.Thread):
+    def __init__(self, results_stream, state_store=None, poll_schedule=None, batch_size=50, flush_interval=5):
+        super().__init__(name='load', daemon=True)
+        self.results_stream = results_stream
+        self.state_store = state_store
+        self.poll_schedule = poll_schedule
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.results_by_carrier = defaultdict(list)
+
+    def flush(self, carrier):
+        tracing_results = self.results_by_carrier.pop(carrier, None)
+        if not tracing_results:
+            return
+        try:
+            load_tracing_results(tracing_results, self.state_store, carrier, self.poll_schedule)
+        except Exception as e:
+            run_metrics.add(carrier, 'load_failures')
+            print('{} load failed: {!r}'.format(carrier, e))
+
+    def flush_all(self):
+        for carrier in list(self.results_by_carrier):
+            self.flush(carrier)
+
+    def run(self):
+        while True:
+            try:
+                carrier, tracing_result = self.results_stream.get(self.flush_interval)
+            except queue.Empty:
+                # A quiet stream means slow carriers, so write out whatever the fast ones left behind
+                self.flush_all()
+                if self.results_stream.is_drained():
+                    return
+                continue
+
+            self.results_by_carrier[carrier].append(tracing_result)
+            if len(self.results_by_carrier[carrier]) >= self.batch_size:
+                self.flush(carrier)
+
+    def finish(self):
+        self.results_stream.close()
+        self.join()
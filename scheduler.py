@@ -0,0 +1,87 @@
+from collections import defaultdict
+from datetime import datetime
+import sqlite3
+import threading
+import time
+
+from dates import get_days_until
+from tracing_result import TracingStatus
+
+minute = 60
+hour = 60 * minute
+
+# Seconds until the next poll; Outgated containers have left the rail and are not polled again
+pending_poll_interval = 4 * hour
+grounded_poll_interval = 2 * hour
+near_last_free_day_poll_interval = 30 * minute
+near_last_free_day_days = 2
+unknown_poll_interval = hour
+eta_poll_intervals = (
+    (7, 12 * hour),
+    (2, 4 * hour),
+    (0, hour),
+)
+
+
+def get_poll_interval(result, now):
+    today = datetime.fromtimestamp(now).date()
+    status = result.current_status
+    if status is TracingStatus.OUTGATED:
+        return None
+    elif status is TracingStatus.GROUNDING:
+        return near_last_free_day_poll_interval
+    elif status is TracingStatus.GROUNDED:
+        days_until_last_free_day = get_days_until(result.last_free_day, today)
+        if days_until_last_free_day is None or days_until_last_free_day <= near_last_free_day_days:
+            return near_last_free_day_poll_interval
+        return grounded_poll_interval
+    elif status is TracingStatus.PENDING:
+        return pending_poll_interval
+
+    days_until_eta = get_days_until(result.eta, today)
+    if days_until_eta is None:
+        return unknown_poll_interval
+    for days, poll_interval in eta_poll_intervals:
+        if days_until_eta >= days:
+            return poll_interval
+    return hour
+
+
+class PollSchedule:
+    def __init__(self, path='tracing_state.sqlite3'):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS poll_schedule ('
+                                'container_number TEXT PRIMARY KEY, '
+                                'current_status TEXT, '
+                                'next_poll_at REAL)')
+        self.connection.commit()
+
+    def get_next_polls_dict(self):
+        with self.lock:
+            rows = self.connection.execute('SELECT container_number, next_poll_at FROM poll_schedule')
+            return dict(rows.fetchall())
+
+    def get_due_containers_by_yard(self, containers_by_yard_dict, now=None):
+        # Containers never traced before are due straight away; a NULL next_poll_at means polling has stopped
+        now = now or time.time()
+        next_polls_dict = self.get_next_polls_dict()
+        due_containers_by_yard_dict = defaultdict(list)
+        for yard, containers_list in containers_by_yard_dict.items():
+            for container in containers_list:
+                if container not in next_polls_dict:
+                    due_containers_by_yard_dict[yard].append(container)
+                elif next_polls_dict[container] is not None and next_polls_dict[container] <= now:
+                    due_containers_by_yard_dict[yard].append(container)
+        return due_containers_by_yard_dict
+
+    def save_results(self, tracing_results, now=None):
+        now = now or time.time()
+        rows = []
+        for result in tracing_results:
+            poll_interval = get_poll_interval(result, now)
+            next_poll_at = now + poll_interval if poll_interval is not None else None
+            rows.append((result.container_number, result.current_status.value, next_poll_at))
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO poll_schedule VALUES (?, ?, ?)', rows)
+            self.connection.commit()
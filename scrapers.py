@@ -1,24 +1,31 @@
-import json
+import asyncio
+from urllib.parse import urljoin
 
-from bs4 import BeautifulSoup
-import requests
-import selenium.webdriver.support.ui as ui
+import aiohttp
+from bs4 import BeautifulSoup, SoupStrainer
 
+from async_extract import gather_limited, run_with_client
+from cn_parser import parse_tracing_results
 from constants.csx_terminals import terminals_dict
-from database import get_containers_from_db, get_mbl_from_container
-from utilities import start_headless_driver
+from constants.ns_event_codes import grounded_event_codes
+from metrics import run_metrics
+from token_cache import token_cache
+from utilities import create_session, get_data_sources, get_driver_pool
 
 
-containers_by_rail_dict = get_containers_from_db('Tracing View')
-data_sources = json.load(open('data_config.json'))["data_sources"]
+# Only the rows/tables the transforms read are kept in the parsed tree
+bnsf_rows_strainer = SoupStrainer('tr', {'id': 'dllRowStyle'})
+cp_results_strainer = SoupStrainer('table', {'id': 'rowTable'})
 user_agent_header = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_1) AppleWebKit'
                                    '/537.36 (KHTML, like Gecko) Chrome/76.0.3809.132 Safari/537.36'}
 
 
 class BNSFScraper:
-    def __init__(self):
-        self.data_source = data_sources["bnsf"]
-        self.containers_list = containers_by_rail_dict['BNSF']
+    def __init__(self, containers_list, parser='lxml', parse_only=bnsf_rows_strainer):
+        self.data_source = get_data_sources()["bnsf"]
+        self.containers_list = containers_list
+        self.parser = parser
+        self.parse_only = parse_only
 
     def get_formatted_containers_list(self):
         formatted_containers_list = []
@@ -28,62 +35,179 @@ class BNSFScraper:
             formatted_containers_list.append(formatted_container)
         return formatted_containers_list
 
-    def get_tracing_results_html(self):
+    async def fetch_tracing_results(self, client):
         if self.containers_list:
             formatted_containers_list = self.get_formatted_containers_list()
-            self.data_source['payload']['equipment'] = ','.join(formatted_containers_list)
-            response = requests.post(self.data_source['api_url'], data=self.data_source['payload'])
+            payload = dict(self.data_source['payload'], equipment=','.join(formatted_containers_list))
+            response = await client.post(self.data_source['api_url'], data=payload)
             if response.status_code == 200:
-                html = BeautifulSoup(response.content, 'html.parser')
+                # Parsed on a thread so the other carriers' requests keep moving meanwhile
+                with run_metrics.timer('BNSF', 'parse_seconds'):
+                    html = await asyncio.to_thread(BeautifulSoup, response.content, self.parser,
+                                                   parse_only=self.parse_only)
                 return html
             else:
                 print('Response status code: {}'.format(response.status_code))
         else:
             print('No containers traveling on BNSF')
 
+    def get_tracing_results_html(self):
+        return run_with_client('BNSF', self.fetch_tracing_results)
+
 
 class CanadianNationalScraper:
-    def __init__(self):
-        self.data_source = data_sources["canadian_national"]
-        self.containers_list = containers_by_rail_dict['CN']
-        self.session = requests.Session()
+    def __init__(self, containers_list, max_url_length=2000, max_workers=4):
+        self.data_source = get_data_sources()["canadian_national"]
+        self.containers_list = containers_list
+        self.max_url_length = max_url_length
+        self.max_workers = max_workers
 
-    def __format_containers_list(self):
-        return ''.join([container[:-1] for container in self.containers_list])
+    @staticmethod
+    def __format_containers_list(containers_list):
+        return ''.join([container[:-1] for container in containers_list])
+
+    def __get_containers_chunks(self):
+        # EquipmentID is a plain concatenation of the IDs, so chunk on the resulting URL length
+        base_url_length = len(self.data_source['api_url'].format('HL', ''))
+        containers_chunks = [[]]
+        url_length = base_url_length
+        for container in dict.fromkeys(self.containers_list):
+            if containers_chunks[-1] and url_length + len(container) - 1 > self.max_url_length:
+                containers_chunks.append([])
+                url_length = base_url_length
+            containers_chunks[-1].append(container)
+            url_length += len(container) - 1
+        return containers_chunks
 
-    def __get_html_dict(self):
-        # Two different formats of API url are needed to collect all required data points
-        formatted_containers_list = self.__format_containers_list()
-        location_response = self.session.get(self.data_source['api_url'].format('HL', formatted_containers_list))
-        eta_response = self.session.get(self.data_source['api_url'].format('HH', formatted_containers_list))
-        location_html = BeautifulSoup(location_response.content, 'lxml')
-        eta_html = BeautifulSoup(eta_response.content, 'lxml')
-        return dict(location_html=location_html, eta_html=eta_html)
+    @staticmethod
+    async def __get_response_content(client, url):
+        return (await client.get(url)).content
 
-    def get_tracing_results_dict(self):
+    @staticmethod
+    def __parse_chunks(containers_chunks, contents):
         tracing_results_dict = {}
+        for i, containers_chunk in enumerate(containers_chunks):
+            tracing_results_dict.update(parse_tracing_results(contents[2 * i], contents[2 * i + 1], containers_chunk))
+        return tracing_results_dict
+
+    async def fetch_tracing_results(self, client):
         if self.containers_list:
-            for container in self.containers_list:
-                tracing_results_dict.update({container: []})
-            containers_html_dict = self.__get_html_dict()
-            for k, v in containers_html_dict.items():
-                tracing_results_rows_list = v.text.split('\n')[5:5 + len(self.containers_list)]
-                for i, container in enumerate(tracing_results_dict.keys()):
-                    tracing_results_dict[container].append(tracing_results_rows_list[i])
-            return tracing_results_dict
+            containers_chunks = self.__get_containers_chunks()
+            # Two different formats of API url are needed to collect all required data points
+            urls = [self.data_source['api_url'].format(response_format, self.__format_containers_list(chunk))
+                    for chunk in containers_chunks for response_format in ('HL', 'HH')]
+            contents = await gather_limited([self.__get_response_content(client, url) for url in urls],
+                                            self.max_workers)
+
+            with run_metrics.timer('CN', 'parse_seconds'):
+                return await asyncio.to_thread(self.__parse_chunks, containers_chunks, contents)
         else:
             print('No containers traveling on CN')
 
+    def get_tracing_results_dict(self):
+        return run_with_client('CN', self.fetch_tracing_results)
+
+
+def get_form_payload(form):
+    # Fields a browser would submit for the form as rendered, submit buttons excluded
+    payload = {}
+    for field in form.find_all(['input', 'textarea', 'select']):
+        name = field.get('name')
+        field_type = field.get('type', 'text').lower()
+        if not name or field_type in ('submit', 'button', 'image', 'reset'):
+            continue
+        if field_type in ('checkbox', 'radio') and not field.has_attr('checked'):
+            continue
+        if field.name == 'textarea':
+            payload[name] = field.text
+        elif field.name == 'select':
+            option = field.find('option', selected=True) or field.find('option')
+            if option:
+                payload[name] = option.get('value', option.text)
+        else:
+            payload[name] = field.get('value', 'on' if field_type in ('checkbox', 'radio') else '')
+    return payload
+
 
 class CanadianPacificScraper:
-    def __init__(self):
-        self.data_source = data_sources["canadian_pacific"]
-        self.driver = start_headless_driver()
-        self.containers_list = containers_by_rail_dict['CP']
+    def __init__(self, containers_list, parser='lxml', parse_only=cp_results_strainer, use_browser_fallback=True,
+                 driver_pool=None):
+        self.data_source = get_data_sources()["canadian_pacific"]
+        self.containers_list = containers_list
+        self.parser = parser
+        self.parse_only = parse_only
+        self.use_browser_fallback = use_browser_fallback
+        self.session = create_session('CP')
+        self.session.headers.update(user_agent_header)
+        self.driver_pool = driver_pool
+        self.driver = None
 
     def __format_containers_list(self):
         return '\n'.join(self.containers_list)
 
+    def __get_form(self, url, field_attrs):
+        response = self.session.get(url)
+        html = BeautifulSoup(response.content, 'html.parser')
+        field = html.find('input', field_attrs) or html.find('textarea', field_attrs)
+        form = field.find_parent('form') if field else None
+        if form:
+            return response.url, form
+
+    @staticmethod
+    def __get_tracing_submit_button(form):
+        # Same button the browser flow clicks: 3rd input of the 15th row of the form table
+        try:
+            table = form.find('table')
+            rows = [row for row in table.find_all('tr') if row.find_parent('table') is table]
+            return rows[14].find('td').find_all('input', recursive=False)[2]
+        except (AttributeError, IndexError):
+            submit_buttons = form.find_all('input', {'type': 'submit'})
+            if submit_buttons:
+                return submit_buttons[-1]
+
+    def __submit_form(self, page_url, form, payload):
+        action_url = urljoin(page_url, form.get('action', ''))
+        if form.get('method', 'get').lower() == 'post':
+            return self.session.post(action_url, data=payload)
+        return self.session.get(action_url, params=payload)
+
+    def __login_with_session(self):
+        login_form = self.__get_form(self.data_source['api_url']['login'], {'id': 'username'})
+        if not login_form:
+            return False
+        page_url, form = login_form
+        payload = get_form_payload(form)
+        payload[form.find('input', {'id': 'username'})['name']] = self.data_source['credentials']['username']
+        payload[form.find('input', {'id': 'password'})['name']] = self.data_source['credentials']['password']
+        login_button = form.find(class_='login_button')
+        if login_button and login_button.get('name'):
+            payload[login_button['name']] = login_button.get('value', '')
+        return self.__submit_form(page_url, form, payload).status_code == 200
+
+    def __get_page_source_with_session(self):
+        if not self.__login_with_session():
+            return
+        tracing_form = self.__get_form(self.data_source['api_url']['tracing'], {'name': 'paramValue3470'})
+        if not tracing_form:
+            return
+        page_url, form = tracing_form
+        payload = get_form_payload(form)
+        payload['paramValue3470'] = self.__format_containers_list()
+        # The browser flow clicks the LFD checkbox, which toggles it
+        lfd_checkbox = form.find('input', {'name': 'paramValue3478'})
+        if lfd_checkbox and lfd_checkbox.has_attr('checked'):
+            payload.pop('paramValue3478', None)
+        else:
+            payload['paramValue3478'] = lfd_checkbox.get('value', 'on') if lfd_checkbox else 'on'
+        submit_button = self.__get_tracing_submit_button(form)
+        if submit_button and submit_button.get('name'):
+            payload[submit_button['name']] = submit_button.get('value', '')
+
+        response = self.__submit_form(page_url, form, payload)
+        if response.status_code == 200 and b'rowTable' in response.content:
+            return response.content
+        print('Response status code: {}'.format(response.status_code))
+
     def __login(self):
         self.driver.get(self.data_source['api_url']['login'])
         username_box = self.driver.find_element_by_id('username')
@@ -103,35 +227,56 @@ class CanadianPacificScraper:
             '/html/body/table[2]/tbody/tr/td[2]/form/table/tbody/tr[15]/td/input[3]')
         tracing_submit_button.click()
 
+    def __get_page_source_with_browser(self):
+        import selenium.webdriver.support.ui as ui
+
+        driver_pool = self.driver_pool or get_driver_pool()
+        with driver_pool.driver() as self.driver:
+            try:
+                self.__login()
+                self.__input_containers_to_trace()
+                wait = ui.WebDriverWait(self.driver, 10)
+                wait.until(lambda driver: driver.find_element_by_id('rowTable'))
+                return self.driver.page_source
+            finally:
+                self.driver = None
+
     def get_tracing_results_html(self):
         if self.containers_list:
-            self.__login()
-            self.__input_containers_to_trace()
-            wait = ui.WebDriverWait(self.driver, 10)
-            wait.until(lambda driver: driver.find_element_by_id('rowTable'))
-            return BeautifulSoup(self.driver.page_source, 'html.parser')
+            # Any failure here, network or a page layout the session flow doesn't expect, falls back to the browser
+            try:
+                page_source = self.__get_page_source_with_session()
+            except Exception as e:
+                print('CP session tracing failed: {!r}'.format(e))
+                page_source = None
+            if not page_source and self.use_browser_fallback:
+                print('CP session tracing failed, falling back to browser')
+                page_source = self.__get_page_source_with_browser()
+            if page_source:
+                with run_metrics.timer('CP', 'parse_seconds'):
+                    return BeautifulSoup(page_source, self.parser, parse_only=self.parse_only)
         else:
             print('No containers traveling on CP')
 
 
 class CSXScraper:
-    def __init__(self):
-        self.data_source = data_sources["csx"]
+    def __init__(self, containers_by_yard_dict, mbls_by_container_dict):
+        self.data_source = get_data_sources()["csx"]
+        self.containers_by_yard_dict = containers_by_yard_dict
+        self.mbls_by_container_dict = mbls_by_container_dict
 
-    @staticmethod
-    def get_containers_dict():
+    def get_containers_dict(self):
         containers_dict = {}
-        for k, v in containers_by_rail_dict.items():
+        for k, v in self.containers_by_yard_dict.items():
             if 'CSX' in k:
                 for container in v:
                     containers_dict.update({container[:-1]: container})
         return containers_dict
 
-    @staticmethod
-    def __get_request_payload():
+    def __get_request_payload(self):
         payload = []
 
-        for k, v in containers_by_rail_dict.items():
+        for k, v in self.containers_by_yard_dict.items():
             if 'CSX' in k:
                 payload_by_terminals = {
                     "terminal": {},
@@ -141,7 +286,7 @@ class CSXScraper:
                 terminal_payload = terminals_dict[terminal_key]
                 payload_by_terminals['terminal'].update(terminal_payload)
                 for container in v:
-                    mbl = get_mbl_from_container(container)
+                    mbl = self.mbls_by_container_dict.get(container, '')
                     if 'CMDU' in mbl:
                         mbl = mbl[4:]
                     shipment_data_template = {
@@ -156,10 +301,11 @@ class CSXScraper:
 
         return payload
 
-    def get_tracing_results_list(self):
+    async def fetch_tracing_results(self, client):
         payload = self.__get_request_payload()
         if payload:
-            response = requests.post(self.data_source['api_url'], json=payload, headers=self.data_source['headers'])
+            response = await client.post(self.data_source['api_url'], json=payload,
+                                         headers=self.data_source['headers'])
             if response.status_code == 200:
                 results_list = response.json()['shipments']
                 for result in response.json()['failedSearchCriteria']:
@@ -170,49 +316,128 @@ class CSXScraper:
         else:
             print('No containers traveling on CSX')
 
+    def get_tracing_results_list(self):
+        return run_with_client('CSX', self.fetch_tracing_results)
+
+
+def find_json_value(obj, key):
+    if isinstance(obj, dict):
+        if obj.get(key):
+            return obj[key]
+        values = obj.values()
+    elif isinstance(obj, list):
+        values = obj
+    else:
+        return
+    for value in values:
+        found_value = find_json_value(value, key)
+        if found_value:
+            return found_value
+
 
 class NorfolkSouthernScraper:
-    def __init__(self):
-        self.session = requests.Session()
-        self.data_source = data_sources["norfolk_southern"]
-        self.containers_list = containers_by_rail_dict['NORFOLK SOUTHERN']
+    token_cache_key = 'norfolk_southern'
 
-    def __login(self):
+    def __init__(self, containers_list, max_workers=8, csrf_token_ttl=20 * 60):
+        # Logins happen under token_cache's file lock, which blocks, so they run on a thread over a requests session
+        self.session = create_session('NS')
         self.session.headers.update(user_agent_header)
-        self.session.headers.update({'Content-Type': 'application/json'})
+        self.headers = dict(user_agent_header, **{'Content-Type': 'application/json'})
+        self.data_source = get_data_sources()["norfolk_southern"]
+        self.containers_list = containers_list
+        self.max_workers = max_workers
+        self.csrf_token_ttl = csrf_token_ttl
+        self.unauthorized = False
+
+    def __login(self):
         return self.session.post(self.data_source['api_url']['login'], json=self.data_source['credentials'])
 
     def __get_csrf_token(self):
         login_response = self.__login()
         if login_response.status_code == 200:
             login_results_dict = login_response.json()
-            return login_results_dict['result']['token']
+            # The token is only valid together with the session cookies it was issued with
+            return dict(token=login_results_dict['result']['token'],
+                        cookies=self.session.cookies.get_dict()), self.csrf_token_ttl
         else:
             print('Response status code: {}'.format(login_response.status_code))
 
-    def get_tracing_results_list(self):
+    async def __authenticate(self, client):
+        credentials_dict = await asyncio.to_thread(token_cache.get, self.token_cache_key, self.__get_csrf_token)
+        if credentials_dict:
+            client.update_cookies(credentials_dict['cookies'], self.data_source['api_url']['login'])
+            self.headers['CSRFTOKEN'] = credentials_dict['token']
+            return True
+        return False
+
+    async def __post(self, client, url, container):
+        # One failed request only costs its own container, not every other result in the run
+        try:
+            response = await client.post(url, json={"searchList": container}, headers=self.headers)
+            if response.status_code == 200:
+                return response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            print('{}: {!r}'.format(container, e))
+            return
+        if response.status_code in (401, 403):
+            self.unauthorized = True
+        print('Response status code: {}'.format(response.status_code))
+
+    async def __get_tracing_result(self, client, container):
+        tracing_result = await self.__post(client, self.data_source['api_url']['tracing'], container)
+        try:
+            equipment_dict = tracing_result['result']['validEquipmentDataList'][0]
+        except (KeyError, IndexError, TypeError):
+            return tracing_result
+
+        # Tracing doesn't always carry the LFD for grounded units, the quick search endpoint does
+        if equipment_dict.get('lastAAREventCode') in grounded_event_codes and \
+                not equipment_dict.get('lastFreeDateTime'):
+            last_free_day_result = await self.__post(client, self.data_source['api_url']['last_free_day'],
+                                                     container)
+            last_free_day = find_json_value(last_free_day_result, 'lastFreeDateTime')
+            if last_free_day:
+                equipment_dict['lastFreeDateTime'] = last_free_day
+        return tracing_result
+
+    async def __get_tracing_results(self, client, containers_list):
+        tracing_results = await gather_limited([self.__get_tracing_result(client, container)
+                                                for container in containers_list], self.max_workers)
+        return {container: tracing_result for container, tracing_result in
+                zip(containers_list, tracing_results) if tracing_result}
+
+    async def fetch_tracing_results(self, client):
         if self.containers_list:
-            tracing_results_list = []
-            csrf_token = self.__get_csrf_token()
-            self.session.headers.update({'CSRFTOKEN': csrf_token})
-            for container in self.containers_list:
-                response = self.session.post(self.data_source['api_url']['tracing'],
-                                             json={"searchList": container})
-                if response.status_code == 200:
-                    tracing_results_list.append(response.json())
-                else:
-                    print('Response status code: {}'.format(response.status_code))
-
-            return tracing_results_list
+            if not await self.__authenticate(client):
+                return
+            tracing_results_dict = await self.__get_tracing_results(client, self.containers_list)
+
+            # A cached token the server no longer accepts: log in again and retry what failed
+            if self.unauthorized:
+                self.unauthorized = False
+                await asyncio.to_thread(token_cache.invalidate, self.token_cache_key)
+                if await self.__authenticate(client):
+                    tracing_results_dict.update(await self.__get_tracing_results(
+                        client, [container for container in self.containers_list
+                                 if container not in tracing_results_dict]))
+            return tracing_results_dict
         else:
             print('No containers traveling on NS')
 
+    def get_tracing_results_dict(self):
+        return run_with_client('NS', self.fetch_tracing_results)
+
 
 class UnionPacificScraper:
-    def __init__(self):
-        self.session = requests.Session()
-        self.data_source = data_sources["union_pacific"]
-        self.containers_list = containers_by_rail_dict['UP']
+    token_cache_key = 'union_pacific'
+
+    def __init__(self, containers_list, max_url_length=2000, max_workers=4):
+        # Token requests happen under token_cache's file lock, which blocks, so they run on a thread over requests
+        self.session = create_session('UP')
+        self.data_source = get_data_sources()["union_pacific"]
+        self.containers_list = containers_list
+        self.max_url_length = max_url_length
+        self.max_workers = max_workers
 
     def __get_request_token(self):
         response = self.session.post(self.data_source['token_url'],
@@ -220,21 +445,57 @@ class UnionPacificScraper:
                                      data=self.data_source['payload'])
         if response.status_code == 200:
             token_dict = response.json()
-            return token_dict['access_token']
+            return token_dict['access_token'], int(token_dict.get('expires_in', 0))
         else:
             print('Response status code: {}'.format(response.status_code))
 
-    def get_tracing_results_dict(self):
+    def __get_containers_chunks(self):
+        # equipmentIds is a comma separated list, so chunk on the resulting URL length
+        base_url_length = len(self.data_source['api_url'].format(''))
+        containers_chunks = [[]]
+        url_length = base_url_length
+        for container in self.containers_list:
+            if containers_chunks[-1] and url_length + len(container) + 1 > self.max_url_length:
+                containers_chunks.append([])
+                url_length = base_url_length
+            containers_chunks[-1].append(container)
+            url_length += len(container) + 1
+        return containers_chunks
+
+    async def __get_tracing_response(self, client, containers_chunk):
+        request_token = await asyncio.to_thread(token_cache.get, self.token_cache_key, self.__get_request_token)
+        headers = {'Authorization': 'Bearer {}'.format(request_token)}
+        url = self.data_source['api_url'].format(','.join(containers_chunk))
+        return await client.get(url, headers=headers)
+
+    async def __get_chunk_results(self, client, containers_chunk):
+        response = await self.__get_tracing_response(client, containers_chunk)
+        if response.status_code == 401:
+            await asyncio.to_thread(token_cache.invalidate, self.token_cache_key)
+            response = await self.__get_tracing_response(client, containers_chunk)
+        if response.status_code == 200:
+            return response.json()
+        else:
+            print('Response status code: {}'.format(response.status_code))
+
+    async def fetch_tracing_results(self, client):
         if self.containers_list:
-            request_token = self.__get_request_token()
-            headers = {'Authorization': 'Bearer {}'.format(request_token)}
-            url = self.data_source['api_url'].format(','.join(self.containers_list))
-            response = self.session.get(url, headers=headers)
-            if response.status_code == 200:
-                return response.json()
-            else:
-                print('Response status code: {}'.format(response.status_code))
+            containers_chunks = self.__get_containers_chunks()
+            chunks_results = await gather_limited([self.__get_chunk_results(client, containers_chunk)
+                                                   for containers_chunk in containers_chunks], self.max_workers)
+
+            # The transform pairs results with containers_list by position, so failed chunks' containers are dropped
+            tracing_results = []
+            traced_containers_list = []
+            for containers_chunk, chunk_results in zip(containers_chunks, chunks_results):
+                if chunk_results is not None:
+                    tracing_results += chunk_results
+                    traced_containers_list += containers_chunk
+            self.containers_list = traced_containers_list
+            if traced_containers_list:
+                return tracing_results
         else:
             print('No containers traveling on UP')
 
-
+    def get_tracing_results_dict(self):
+        return run_with_client('UP', self.fetch_tracing_results)
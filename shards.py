@@ -0,0 +1,203 @@
+from collections import defaultdict
+from itertools import chain, zip_longest
+import json
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+
+from utilities import get_carrier_from_yard
+
+# Shards are handed out through a SQLite file, so workers only need to open the same path: local processes share
+# it directly and other boxes through a shared mount. Workers hold a lease on the shard they are tracing and renew
+# it while they work; a worker that dies stops renewing, and once the lease expires any worker can take the shard.
+# Several coordinators can share one file: each heartbeats its run while it waits for the shards, removes the run
+# once it is finished, and a run whose coordinator stopped heartbeating is abandoned and swept by the next one.
+default_shard_size = 500
+default_lease_seconds = 120
+max_shard_attempts = 3
+
+
+def get_shard_index(container, shards_count):
+    # crc32 rather than hash(), which is salted per process and would shard differently on every box
+    return zlib.crc32(container.encode()) % shards_count
+
+
+def split_into_shards(containers_by_yard_dict, shard_size=default_shard_size):
+    # [(carrier, containers_by_yard_dict)] with each carrier's containers hashed into shards of about shard_size
+    yards_by_carrier_dict = defaultdict(list)
+    for yard, containers_list in containers_by_yard_dict.items():
+        if containers_list:
+            yards_by_carrier_dict[get_carrier_from_yard(yard)].append(yard)
+
+    shards_by_carrier_list = []
+    for carrier, yards_list in sorted(yards_by_carrier_dict.items()):
+        containers_count = sum(len(containers_by_yard_dict[yard]) for yard in yards_list)
+        shard_dicts = [defaultdict(list) for _ in range(-(-containers_count // shard_size))]
+        for yard in yards_list:
+            for container in containers_by_yard_dict[yard]:
+                shard_dicts[get_shard_index(container, len(shard_dicts))][yard].append(container)
+        shards_by_carrier_list.append([(carrier, dict(shard_dict)) for shard_dict in shard_dicts if shard_dict])
+
+    # Carriers take turns so workers leasing in order spread over carrier hosts instead of all hitting one
+    return [shard for shard in chain.from_iterable(zip_longest(*shards_by_carrier_list)) if shard]
+
+
+class ShardQueue:
+    def __init__(self, path='tracing_shards.sqlite3', shard_size=default_shard_size,
+                 lease_seconds=default_lease_seconds, max_attempts=max_shard_attempts):
+        self.path = path
+        self.shard_size = shard_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        # Other processes write to the same file, so wait for their transactions instead of failing as locked
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS shards ('
+                                'shard_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                'run_id TEXT NOT NULL, '
+                                'carrier TEXT NOT NULL, '
+                                'payload TEXT NOT NULL, '
+                                'status TEXT NOT NULL, '
+                                'attempts INTEGER NOT NULL DEFAULT 0, '
+                                'lease_id TEXT, '
+                                'worker_id TEXT, '
+                                'lease_expires_at REAL, '
+                                'output TEXT, '
+                                'error TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS runs ('
+                                'run_id TEXT PRIMARY KEY, '
+                                'heartbeat_at REAL NOT NULL)')
+        self.connection.commit()
+
+    def get_abandoned_before(self):
+        # Coordinators heartbeat every few seconds, so one silent for a whole lease has stopped
+        return time.time() - self.lease_seconds
+
+    def enqueue_run(self, run_id, shards_list):
+        # Only abandoned runs are swept; other coordinators' runs are still being waited on
+        rows = [(run_id, carrier, json.dumps(payload), 'pending') for carrier, payload in shards_list]
+        with self.lock:
+            abandoned_before = self.get_abandoned_before()
+            self.connection.execute('DELETE FROM shards WHERE run_id NOT IN '
+                                    '(SELECT run_id FROM runs WHERE heartbeat_at >= ?)', (abandoned_before,))
+            self.connection.execute('DELETE FROM runs WHERE heartbeat_at < ?', (abandoned_before,))
+            self.connection.execute('INSERT INTO runs (run_id, heartbeat_at) VALUES (?, ?)', (run_id, time.time()))
+            self.connection.executemany('INSERT INTO shards (run_id, carrier, payload, status) VALUES (?, ?, ?, ?)',
+                                        rows)
+            self.connection.commit()
+
+    def heartbeat(self, run_id):
+        with self.lock:
+            self.connection.execute('UPDATE runs SET heartbeat_at = ? WHERE run_id = ?', (time.time(), run_id))
+            self.connection.commit()
+
+    def finish_run(self, run_id):
+        with self.lock:
+            self.connection.execute('DELETE FROM shards WHERE run_id = ?', (run_id,))
+            self.connection.execute('DELETE FROM runs WHERE run_id = ?', (run_id,))
+            self.connection.commit()
+
+    def lease(self, worker_id):
+        # A single UPDATE, so two workers can never lease the same shard. Shards of abandoned runs are skipped, as
+        # nobody is waiting for their results
+        now = time.time()
+        lease_id = uuid.uuid4().hex
+        with self.lock:
+            cursor = self.connection.execute(
+                "UPDATE shards SET status = 'leased', lease_id = ?, worker_id = ?, lease_expires_at = ?, "
+                "attempts = attempts + 1 "
+                "WHERE shard_id = (SELECT shard_id FROM shards "
+                "                  WHERE (status = 'pending' OR (status = 'leased' AND lease_expires_at < ?)) "
+                "                  AND attempts < ? AND run_id IN (SELECT run_id FROM runs WHERE heartbeat_at >= ?) "
+                "                  ORDER BY shard_id LIMIT 1)",
+                (lease_id, worker_id, now + self.lease_seconds, now, self.max_attempts, self.get_abandoned_before()))
+            self.connection.commit()
+            if cursor.rowcount == 0:
+                return None
+            shard_id, carrier, payload = self.connection.execute(
+                'SELECT shard_id, carrier, payload FROM shards WHERE lease_id = ?', (lease_id,)).fetchone()
+        return shard_id, lease_id, carrier, json.loads(payload)
+
+    def renew(self, shard_id, lease_id):
+        with self.lock:
+            cursor = self.connection.execute("UPDATE shards SET lease_expires_at = ? "
+                                             "WHERE shard_id = ? AND lease_id = ? AND status = 'leased'",
+                                             (time.time() + self.lease_seconds, shard_id, lease_id))
+            self.connection.commit()
+        return cursor.rowcount == 1
+
+    def complete(self, shard_id, lease_id, output):
+        # Rejected when the lease was lost to another worker, whose results will be the ones loaded
+        with self.lock:
+            cursor = self.connection.execute("UPDATE shards SET status = 'done', output = ? "
+                                             "WHERE shard_id = ? AND lease_id = ? AND status = 'leased'",
+                                             (json.dumps(output), shard_id, lease_id))
+            self.connection.commit()
+        return cursor.rowcount == 1
+
+    def release(self, shard_id, lease_id, error):
+        with self.lock:
+            self.connection.execute("UPDATE shards SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' "
+                                    "END, lease_id = NULL, error = ? "
+                                    "WHERE shard_id = ? AND lease_id = ? AND status = 'leased'",
+                                    (self.max_attempts, error, shard_id, lease_id))
+            self.connection.commit()
+
+    def expire_leases(self, worker_id):
+        # For a worker known to be dead, so its shard doesn't wait out the lease
+        with self.lock:
+            self.connection.execute("UPDATE shards SET lease_expires_at = 0 WHERE worker_id = ? AND status = 'leased'",
+                                    (worker_id,))
+            self.connection.commit()
+
+    def fail_expired_shards(self, run_id):
+        # Shards out of attempts can't be leased again, so an expired lease on one means it is lost
+        with self.lock:
+            self.connection.execute("UPDATE shards SET status = 'failed', error = 'lease expired' "
+                                    "WHERE run_id = ? AND status = 'leased' AND lease_expires_at < ? "
+                                    "AND attempts >= ?", (run_id, time.time(), self.max_attempts))
+            self.connection.commit()
+
+    def take_finished_shards(self, run_id):
+        # [(carrier, output)] for shards finished since the last call; each is handed over exactly once
+        with self.lock:
+            rows = self.connection.execute("SELECT shard_id, carrier, output FROM shards "
+                                           "WHERE run_id = ? AND status = 'done' ORDER BY shard_id",
+                                           (run_id,)).fetchall()
+            self.connection.executemany("UPDATE shards SET status = 'delivered', output = NULL WHERE shard_id = ?",
+                                        [(shard_id,) for shard_id, carrier, output in rows])
+            self.connection.commit()
+        return [(carrier, json.loads(output)) for shard_id, carrier, output in rows]
+
+    def get_run_counts_dict(self, run_id):
+        with self.lock:
+            rows = self.connection.execute('SELECT status, COUNT(*), SUM(attempts) FROM shards WHERE run_id = ? '
+                                           'GROUP BY status', (run_id,)).fetchall()
+        counts_dict = {status: shards_count for status, shards_count, attempts in rows}
+        counts_dict['attempts'] = sum(attempts for status, shards_count, attempts in rows)
+        return counts_dict
+
+    def is_run_finished(self, run_id):
+        counts_dict = self.get_run_counts_dict(run_id)
+        return not any(counts_dict.get(status) for status in ('pending', 'leased', 'done'))
+
+
+class LeaseKeeper(threading.Thread):
+    # Renews a shard's lease while the worker traces it, for as long as the worker process is alive
+    def __init__(self, shard_queue, shard_id, lease_id):
+        super().__init__(name='lease', daemon=True)
+        self.shard_queue = shard_queue
+        self.shard_id = shard_id
+        self.lease_id = lease_id
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.shard_queue.lease_seconds / 3):
+            if not self.shard_queue.renew(self.shard_id, self.lease_id):
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
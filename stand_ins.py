@@ -0,0 +1,319 @@
+from collections import deque
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import cycle, islice
+import json
+import random
+import re
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from benchmarks import bnsf_row_pattern, read_fixture, scale_cn_response, scale_html_rows
+from constants.csx_terminals import terminals_dict
+
+# Local stand-ins for the Airtable REST API and the BNSF, CN, CSX, UP and NS endpoints in data_config.json.
+# Responses are built from the recorded fixtures, so every transform status shows up at any container count.
+airtable_page_size = 100
+airtable_time_format = '%Y-%m-%dT%H:%M:%S.%fZ'
+# The terms of view_sync.get_modified_since_formula: IS_AFTER(LAST_MODIFIED_TIME({A}, {B}), DATETIME_PARSE('...'))
+is_after_pattern = re.compile(r"IS_AFTER\((LAST_MODIFIED_TIME|CREATED_TIME)\(([^)]*)\), DATETIME_PARSE\('([^']+)'\)\)")
+stand_in_yards = ['BNSF', 'CN', 'CSX - {}'.format(next(iter(terminals_dict))), 'UP', 'NORFOLK SOUTHERN']
+
+
+def get_timestamp(airtable_time):
+    return datetime.strptime(airtable_time, airtable_time_format).replace(tzinfo=timezone.utc).timestamp()
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler_class, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests_count = 0
+        self.errors_count = 0
+        self.counts_lock = threading.Lock()
+        super().__init__(('127.0.0.1', 0), handler_class)
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_port)
+
+    def handle_error(self, request, client_address):
+        # A carrier cancelled at its timeout hangs up on requests still in flight
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def read_json(self):
+        return json.loads(self.read_body() or b'null')
+
+    def send_body(self, body, status=200, content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, value, status=200, headers=None):
+        self.send_body(json.dumps(value).encode(), status, headers=headers)
+
+    def handle_request(self, method):
+        server = self.server
+        with server.counts_lock:
+            server.requests_count += 1
+        if server.latency:
+            time.sleep(random.uniform(0.5, 1.5) * server.latency)
+        if random.random() < server.error_rate:
+            with server.counts_lock:
+                server.errors_count += 1
+            self.read_body()
+            self.send_json({'error': 'injected failure'}, status=503)
+            return
+        url = urlsplit(self.path)
+        getattr(self, 'handle_{}'.format(method))(url.path, parse_qs(url.query))
+
+    def do_GET(self):
+        self.handle_request('get')
+
+    def do_POST(self):
+        self.handle_request('post')
+
+    def do_PATCH(self):
+        self.handle_request('patch')
+
+
+class AirtableServer(StandInServer):
+    def __init__(self, containers_count, rate_limit=5, lockout_seconds=30, **kwargs):
+        self.rate_limit = rate_limit
+        self.lockout_seconds = lockout_seconds
+        self.request_times = deque()
+        self.records = []
+        self.records_dict = {}
+        # What LAST_MODIFIED_TIME and CREATED_TIME read, {record id: {field: epoch seconds}} and {record id: epoch}
+        self.modified_times_dict = {}
+        self.created_times_dict = {}
+        created_at = datetime(2020, 1, 1, tzinfo=timezone.utc).timestamp()
+        for i in range(containers_count):
+            self.add_record(i, created_at)
+        self.records_written = 0
+        self.rate_limited_count = 0
+        super().__init__(AirtableHandler, **kwargs)
+
+    def add_record(self, i, created_at):
+        # Six serial digits and a check digit, since CN and CSX key on the number without its check digit
+        container = 'LOAD{:06d}{}'.format(i, i % 10)
+        record = dict(id='rec{:014d}'.format(i),
+                      createdTime=datetime.fromtimestamp(created_at, timezone.utc).strftime(airtable_time_format),
+                      fields={'Container': container,
+                              'Container Yard': [stand_in_yards[i % len(stand_in_yards)]],
+                              'MBL': ['CMDU{:09d}'.format(i)]})
+        self.records.append(record)
+        self.records_dict[record['id']] = record
+        self.created_times_dict[record['id']] = created_at
+        self.modified_times_dict[record['id']] = dict.fromkeys(record['fields'], created_at)
+
+    def change_records(self, changes_count):
+        # Adds changes_count records and moves as many existing ones to the next yard, the edits an incremental
+        # sync has to pick up
+        now = time.time()
+        for record in self.records[:changes_count]:
+            yard = stand_in_yards[(stand_in_yards.index(record['fields']['Container Yard'][0]) + 1) %
+                                  len(stand_in_yards)]
+            record['fields']['Container Yard'] = [yard]
+            self.modified_times_dict[record['id']]['Container Yard'] = now
+        for i in range(len(self.records), len(self.records) + changes_count):
+            self.add_record(i, now)
+
+    def is_rate_limited(self):
+        # Airtable counts requests per base over a rolling second
+        now = time.monotonic()
+        with self.counts_lock:
+            while self.request_times and now - self.request_times[0] >= 1:
+                self.request_times.popleft()
+            if len(self.request_times) >= self.rate_limit:
+                self.rate_limited_count += 1
+                return True
+            self.request_times.append(now)
+        return False
+
+
+class AirtableHandler(StandInHandler):
+    def handle_request(self, method):
+        if self.server.is_rate_limited():
+            self.read_body()
+            self.send_json({'errors': [{'error': 'RATE_LIMIT_REACHED'}]}, status=429,
+                           headers={'Retry-After': str(self.server.lockout_seconds)})
+            return
+        super().handle_request(method)
+
+    def is_after(self, record, function, arguments, since):
+        created_at = self.server.created_times_dict[record['id']]
+        if function == 'CREATED_TIME':
+            return created_at > since
+        # LAST_MODIFIED_TIME() without fields covers them all, and a field never edited dates from the record
+        modified_times_dict = self.server.modified_times_dict[record['id']]
+        fields = re.findall(r'{([^}]+)}', arguments) or modified_times_dict
+        return max(modified_times_dict.get(field, created_at) for field in fields) > since
+
+    def get_matching_records(self, records, formula):
+        # The single-field search used by ContainerIndex, and the OR of IS_AFTER terms the incremental sync uses;
+        # anything else matches nothing
+        if not formula:
+            return records
+        if formula.startswith('{') and '}=' in formula:
+            field, value = formula[1:].split('}=', 1)
+            value = value.strip("'")
+            return [record for record in records if record['fields'].get(field) == value]
+        terms = [(function, arguments, get_timestamp(since))
+                 for function, arguments, since in is_after_pattern.findall(formula)]
+        return [record for record in records if any(self.is_after(record, *term) for term in terms)]
+
+    def handle_get(self, path, query):
+        records = self.get_matching_records(self.server.records, query.get('filterByFormula', [None])[0])
+        fields = query.get('fields[]')
+        offset = int(query.get('offset', ['0'])[0])
+        page_size = int(query.get('pageSize', [airtable_page_size])[0])
+        page = []
+        for record in records[offset:offset + page_size]:
+            if fields:
+                record = dict(record, fields={name: value for name, value in record['fields'].items()
+                                              if name in fields})
+            page.append(record)
+        response = {'records': page}
+        if offset + page_size < len(records):
+            response['offset'] = str(offset + page_size)
+        self.send_json(response)
+
+    def handle_patch(self, path, query):
+        updated_records = []
+        for patch in self.read_json()['records']:
+            record = self.server.records_dict.get(patch['id'])
+            if record is None:
+                self.send_json({'error': {'type': 'ROW_DOES_NOT_EXIST'}}, status=422)
+                return
+            now = time.time()
+            for field, value in patch['fields'].items():
+                if record['fields'].get(field) != value:
+                    self.server.modified_times_dict[record['id']][field] = now
+            record['fields'].update(patch['fields'])
+            updated_records.append(record)
+        with self.server.counts_lock:
+            self.server.records_written += len(updated_records)
+        self.send_json({'records': updated_records})
+
+
+class BNSFHandler(StandInHandler):
+    def handle_post(self, path, query):
+        equipment = parse_qs(self.read_body().decode()).get('equipment', [''])[0]
+        units_count = len([unit for unit in equipment.split(',') if unit])
+        html = scale_html_rows(read_fixture('bnsf.html'), bnsf_row_pattern, units_count)
+        self.send_body(html.encode(), content_type='text/html')
+
+
+class CanadianNationalHandler(StandInHandler):
+    def handle_get(self, path, query):
+        # EquipmentID is the 10 character IDs run together
+        units_count = len(query.get('EquipmentID', [''])[0]) // 10
+        file_name = 'cn_hh.html' if query.get('Format', ['HL'])[0] == 'HH' else 'cn_hl.html'
+        self.send_body(scale_cn_response(read_fixture(file_name, 'rb'), units_count), content_type='text/html')
+
+
+class CSXHandler(StandInHandler):
+    def handle_post(self, path, query):
+        equipment_ids = [shipment['equipmentID'] for terminal in self.read_json()
+                         for shipment in terminal['shipmentData']]
+        shipments = []
+        for equipment_id, recorded_shipment in zip(equipment_ids, cycle(json.loads(read_fixture('csx.json')))):
+            shipments.append(dict(recorded_shipment, equipment={'equipmentID': equipment_id}))
+        self.send_json({'shipments': shipments, 'failedSearchCriteria': []})
+
+
+class UnionPacificHandler(StandInHandler):
+    def handle_post(self, path, query):
+        self.read_body()
+        self.send_json({'access_token': 'stand-in', 'token_type': 'bearer', 'expires_in': 3600})
+
+    def handle_get(self, path, query):
+        units_count = len([unit for unit in query.get('equipmentIds', [''])[0].split(',') if unit])
+        self.send_json(list(islice(cycle(json.loads(read_fixture('up.json'))), units_count)))
+
+
+class NorfolkSouthernHandler(StandInHandler):
+    def handle_post(self, path, query):
+        request_dict = self.read_json()
+        if path.endswith('/login'):
+            self.send_json({'result': {'token': 'stand-in'}}, headers={'Set-Cookie': 'JSESSIONID=stand-in; Path=/'})
+        elif path.endswith('/carUnitsInfoSearch'):
+            self.send_json({'result': {'carUnits': [{'lastFreeDateTime': '2020-01-20T23:59:00'}]}})
+        else:
+            recorded_results = json.loads(read_fixture('ns.json'))
+            container = request_dict['searchList']
+            self.send_json(recorded_results[sum(map(ord, container)) % len(recorded_results)])
+
+
+carrier_handlers_dict = {
+    'bnsf': BNSFHandler,
+    'canadian_national': CanadianNationalHandler,
+    'csx': CSXHandler,
+    'union_pacific': UnionPacificHandler,
+    'norfolk_southern': NorfolkSouthernHandler,
+}
+
+
+def replace_hosts(value, base_url):
+    if isinstance(value, dict):
+        return {key: replace_hosts(item, base_url) for key, item in value.items()}
+    elif isinstance(value, str) and value.startswith(('http://', 'https://')):
+        url = urlsplit(value)
+        return value.replace('{}://{}'.format(url.scheme, url.netloc), base_url, 1)
+    return value
+
+
+class StandIns:
+    def __init__(self, containers_count, latency=0.0, error_rate=0.0, airtable_rate_limit=5):
+        self.airtable = AirtableServer(containers_count, rate_limit=airtable_rate_limit, latency=latency,
+                                       error_rate=error_rate).start()
+        self.carriers_dict = {name: StandInServer(handler_class, latency, error_rate).start()
+                              for name, handler_class in carrier_handlers_dict.items()}
+
+    def get_data_config(self, data_config):
+        # The real config with every carrier host swapped for its stand-in (CP has none and keeps its URLs)
+        data_sources = dict(data_config['data_sources'])
+        for name, server in self.carriers_dict.items():
+            data_sources[name] = replace_hosts(data_sources[name], server.base_url)
+        data_sources['airtable'] = dict(data_sources['airtable'], api_url='{}/v0'.format(self.airtable.base_url))
+        return dict(data_config, data_sources=data_sources)
+
+    def get_counts_dict(self):
+        counts_dict = {name: dict(requests=server.requests_count, errors=server.errors_count)
+                       for name, server in self.carriers_dict.items()}
+        counts_dict['airtable'] = dict(requests=self.airtable.requests_count, errors=self.airtable.errors_count,
+                                       rate_limited=self.airtable.rate_limited_count,
+                                       records_written=self.airtable.records_written)
+        return counts_dict
+
+    def stop(self):
+        for server in [self.airtable] + list(self.carriers_dict.values()):
+            server.stop()
@@ -0,0 +1,61 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+# Fields that change only when the carrier reports something new (timestamp is excluded on purpose)
+semantic_fields = ('current_status', 'most_recent_event', 'scheduled_event', 'eta', 'last_free_day')
+# Below SQLite's default limit on host parameters per statement
+max_query_parameters = 900
+
+
+def get_result_hash(result):
+    semantic_dict = {field: getattr(result, field) for field in semantic_fields}
+    # Hash the status by its value so hashes match those stored before results were typed
+    semantic_dict['current_status'] = result.current_status.value
+    return hashlib.sha1(json.dumps(semantic_dict, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class TracingStateStore:
+    def __init__(self, path='tracing_state.sqlite3', refresh_after=24 * 60 * 60):
+        self.refresh_after = refresh_after
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS tracing_state ('
+                                'container_number TEXT PRIMARY KEY, '
+                                'result_hash TEXT NOT NULL, '
+                                'written_at REAL NOT NULL)')
+        self.connection.commit()
+
+    def get_states_dict(self, container_numbers):
+        # Only the batch's containers, so each load batch costs the same however large the table grows
+        container_numbers = list(container_numbers)
+        states_dict = {}
+        with self.lock:
+            for i in range(0, len(container_numbers), max_query_parameters):
+                chunk = container_numbers[i:i + max_query_parameters]
+                rows = self.connection.execute('SELECT container_number, result_hash, written_at FROM tracing_state '
+                                               'WHERE container_number IN ({})'.format(', '.join('?' * len(chunk))),
+                                               chunk)
+                states_dict.update({container_number: (result_hash, written_at)
+                                    for container_number, result_hash, written_at in rows})
+        return states_dict
+
+    def get_changed_results(self, tracing_results):
+        states_dict = self.get_states_dict(result.container_number for result in tracing_results)
+        now = time.time()
+        changed_results = []
+        for result in tracing_results:
+            state = states_dict.get(result.container_number)
+            # Unchanged containers are still rewritten once in a while so their timestamp doesn't go stale
+            if state is None or state[0] != get_result_hash(result) or now - state[1] > self.refresh_after:
+                changed_results.append(result)
+        return changed_results
+
+    def save_results(self, tracing_results):
+        now = time.time()
+        rows = [(result.container_number, get_result_hash(result), now) for result in tracing_results]
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO tracing_state VALUES (?, ?, ?)', rows)
+            self.connection.commit()
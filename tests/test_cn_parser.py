@@ -0,0 +1,86 @@
+import os
+
+from bs4 import BeautifulSoup
+import pytest
+
+from cn_parser import CanadianNationalRecord, get_response_rows, parse_tracing_results
+
+fixtures_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fixtures')
+containers_list = ['TCLU1234565', 'MSCU7654320', 'CAIU1111114', 'TGHU2222229']
+
+
+def read_fixture(file_name):
+    with open(os.path.join(fixtures_path, file_name), 'rb') as fixture_file:
+        return fixture_file.read()
+
+
+def get_lf_response(content):
+    return content.replace(b'\r\n', b'\n')
+
+
+def get_prologue_response(content):
+    return b'<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN">\r\n<!-- CN STI -->\r\n' + content
+
+
+def get_entities_response(content):
+    return content.replace(b'TORONTO ON', b'TORONTO&nbsp;ON').replace(b'CHICAGO IL', b'CHICAGO &amp; IL')
+
+
+def get_no_record_response(content):
+    # Every unit unknown to CN, the way it answers for a batch of bad container numbers
+    header, separator, rows = content.partition(b'-----------\r\n')
+    rows_list = rows.split(b'\r\n')
+    no_record_rows = [row[:11] + b' NO RECORD FOUND' for row in rows_list[:len(containers_list)]]
+    return header + separator + b'\r\n'.join(no_record_rows + rows_list[len(containers_list):])
+
+
+response_variants = [
+    lambda content: content,
+    get_lf_response,
+    get_prologue_response,
+    get_entities_response,
+    get_no_record_response,
+]
+
+
+def get_soup_rows(content, rows_count):
+    # The path cn_parser replaced: lxml text extraction, then the report rows after the five header lines
+    return BeautifulSoup(content, 'lxml').text.split('\n')[5:5 + rows_count]
+
+
+def get_soup_record(location_row, eta_row):
+    # Token offsets of the previous CanadianNationalTransform
+    location_tokens = location_row.split()
+    most_recent_location = ', '.join(location_tokens[2:4])
+    if 'RECORD' in most_recent_location:
+        return CanadianNationalRecord(most_recent_location, None, None, None, None)
+    eta_tokens = eta_row.split()
+    return CanadianNationalRecord(most_recent_location, ', '.join(location_tokens[9:11]), location_tokens[7],
+                                  ''.join(location_tokens[4:6]), eta_tokens[-1] if eta_tokens else '')
+
+
+@pytest.mark.parametrize('file_name', ['cn_hl.html', 'cn_hh.html'])
+@pytest.mark.parametrize('get_variant', response_variants)
+def test_rows_match_lxml_text(file_name, get_variant):
+    content = get_variant(read_fixture(file_name))
+    assert get_response_rows(content, len(containers_list)) == get_soup_rows(content, len(containers_list))
+
+
+@pytest.mark.parametrize('get_variant', response_variants)
+def test_records_match_previous_path(get_variant):
+    location_content = get_variant(read_fixture('cn_hl.html'))
+    eta_content = get_variant(read_fixture('cn_hh.html'))
+    expected_dict = {container: get_soup_record(location_row, eta_row) for container, location_row, eta_row in
+                     zip(containers_list, get_soup_rows(location_content, len(containers_list)),
+                         get_soup_rows(eta_content, len(containers_list)))}
+    assert parse_tracing_results(location_content, eta_content, containers_list) == expected_dict
+
+
+def test_recorded_responses():
+    records_dict = parse_tracing_results(read_fixture('cn_hl.html'), read_fixture('cn_hh.html'), containers_list)
+    assert records_dict == {
+        'TCLU1234565': CanadianNationalRecord('MONTREAL, QC', 'TORONTO, ON', 'A', '0112@1030', '0115'),
+        'MSCU7654320': CanadianNationalRecord('NO, RECORD', None, None, None, None),
+        'CAIU1111114': CanadianNationalRecord('CHICAGO, IL', 'CHICAGO, IL', 'Y', '0201@2359', 'N/A'),
+        'TGHU2222229': CanadianNationalRecord('WINNIPEG, MB', 'VANCOUVER, BC', 'P', '1231@0001', 'ETA0105'),
+    }
@@ -0,0 +1,151 @@
+import pytest
+
+import shards
+from shards import ShardQueue, split_into_shards
+
+containers_by_yard_dict = {
+    'BNSF': ['TCLU{:07d}'.format(i) for i in range(10)],
+    'UP': ['MSCU{:07d}'.format(i) for i in range(10)],
+}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(shards.time, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def queue_path(tmp_path):
+    return str(tmp_path / 'shards.sqlite3')
+
+
+def get_queue(queue_path, **kwargs):
+    return ShardQueue(queue_path, shard_size=5, lease_seconds=60, max_attempts=3, **kwargs)
+
+
+def get_shards_list(prefix='run'):
+    return [(carrier, dict(prefix=prefix, containers_by_yard=payload))
+            for carrier, payload in split_into_shards(containers_by_yard_dict, 5)]
+
+
+def drain(shard_queue, worker_id):
+    leased_list = []
+    while True:
+        shard = shard_queue.lease(worker_id)
+        if shard is None:
+            return leased_list
+        leased_list.append(shard)
+
+
+def test_split_into_shards_interleaves_carriers():
+    shards_list = split_into_shards(containers_by_yard_dict, 5)
+    assert [carrier for carrier, payload in shards_list] == ['BNSF', 'UP', 'BNSF', 'UP']
+    assert sorted(container for carrier, payload in shards_list for containers in payload.values()
+                  for container in containers) == sorted(sum(containers_by_yard_dict.values(), []))
+
+
+def test_coordinators_share_one_file(clock, queue_path):
+    first_queue = get_queue(queue_path)
+    second_queue = get_queue(queue_path)
+    first_queue.enqueue_run('first', get_shards_list('first'))
+    second_queue.enqueue_run('second', get_shards_list('second'))
+    assert not first_queue.is_run_finished('first')
+    assert not second_queue.is_run_finished('second')
+
+    worker_queue = get_queue(queue_path)
+    for shard_id, lease_id, carrier, payload in drain(worker_queue, 'worker'):
+        assert worker_queue.complete(shard_id, lease_id, dict(prefix=payload['prefix']))
+
+    assert [output['prefix'] for carrier, output in first_queue.take_finished_shards('first')] == ['first'] * 4
+    assert first_queue.is_run_finished('first')
+    first_queue.finish_run('first')
+    assert not second_queue.is_run_finished('second')
+    assert [output['prefix'] for carrier, output in second_queue.take_finished_shards('second')] == ['second'] * 4
+    assert second_queue.get_run_counts_dict('second') == dict(delivered=4, attempts=4)
+
+
+def test_abandoned_runs_are_skipped_and_swept(clock, queue_path):
+    shard_queue = get_queue(queue_path)
+    shard_queue.enqueue_run('abandoned', get_shards_list())
+    clock.now += 30
+    shard_queue.enqueue_run('live', get_shards_list())
+    clock.now += 40
+    shard_queue.heartbeat('live')
+
+    leased_list = drain(shard_queue, 'worker')
+    assert len(leased_list) == 4
+    assert shard_queue.get_run_counts_dict('abandoned') == dict(pending=4, attempts=0)
+
+    shard_queue.enqueue_run('next', get_shards_list())
+    assert shard_queue.get_run_counts_dict('abandoned') == dict(attempts=0)
+    assert shard_queue.get_run_counts_dict('live') == dict(leased=4, attempts=4)
+
+
+def test_expired_lease_is_taken_over(clock, queue_path):
+    shard_queue = get_queue(queue_path)
+    shard_queue.enqueue_run('run', get_shards_list()[:1])
+    shard_id, lease_id, carrier, payload = shard_queue.lease('dead')
+    assert shard_queue.lease('other') is None
+
+    clock.now += 61
+    shard_queue.heartbeat('run')
+    shard_id, taken_lease_id, carrier, payload = shard_queue.lease('other')
+    assert not shard_queue.renew(shard_id, lease_id)
+    assert not shard_queue.complete(shard_id, lease_id, dict(worker='dead'))
+    assert shard_queue.complete(shard_id, taken_lease_id, dict(worker='other'))
+    assert shard_queue.take_finished_shards('run') == [(carrier, dict(worker='other'))]
+
+
+def test_dead_worker_leases_expire_at_once(clock, queue_path):
+    shard_queue = get_queue(queue_path)
+    shard_queue.enqueue_run('run', get_shards_list()[:1])
+    shard_queue.lease('dead')
+    shard_queue.expire_leases('dead')
+    assert shard_queue.lease('other') is not None
+
+
+def test_released_shard_is_retried(clock, queue_path):
+    shard_queue = get_queue(queue_path)
+    shard_queue.enqueue_run('run', get_shards_list()[:1])
+    shard_id, lease_id, carrier, payload = shard_queue.lease('worker')
+    shard_queue.release(shard_id, lease_id, 'ConnectionError()')
+    assert shard_queue.get_run_counts_dict('run') == dict(pending=1, attempts=1)
+
+    retried_shard_id, lease_id, carrier, payload = shard_queue.lease('worker')
+    assert retried_shard_id == shard_id
+    assert shard_queue.complete(shard_id, lease_id, dict(rows=1))
+    assert shard_queue.get_run_counts_dict('run') == dict(done=1, attempts=2)
+
+
+def test_shard_fails_after_max_attempts(clock, queue_path):
+    shard_queue = get_queue(queue_path)
+    shard_queue.enqueue_run('run', get_shards_list()[:1])
+    for _ in range(3):
+        shard_id, lease_id, carrier, payload = shard_queue.lease('worker')
+        shard_queue.release(shard_id, lease_id, 'ConnectionError()')
+    assert shard_queue.lease('worker') is None
+    assert shard_queue.get_run_counts_dict('run') == dict(failed=1, attempts=3)
+    assert shard_queue.is_run_finished('run')
+
+
+def test_expired_last_attempt_fails(clock, queue_path):
+    shard_queue = get_queue(queue_path)
+    shard_queue.enqueue_run('run', get_shards_list()[:1])
+    for _ in range(3):
+        shard_queue.lease('dead')
+        clock.now += 61
+        shard_queue.heartbeat('run')
+    assert not shard_queue.is_run_finished('run')
+    shard_queue.fail_expired_shards('run')
+    assert shard_queue.get_run_counts_dict('run') == dict(failed=1, attempts=3)
+    assert shard_queue.is_run_finished('run')
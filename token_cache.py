@@ -0,0 +1,62 @@
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import threading
+import time
+
+
+class TokenCache:
+    def __init__(self, path='.token_cache.json', refresh_margin=60):
+        self.path = path
+        self.lock_path = '{}.lock'.format(path)
+        self.refresh_margin = refresh_margin
+        self.thread_lock = threading.Lock()
+
+    @contextmanager
+    def locked(self):
+        # The thread lock covers threads of this process, flock covers other processes
+        with self.thread_lock, open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_tokens(self):
+        try:
+            with open(self.path) as tokens_file:
+                return json.load(tokens_file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def write_tokens(self, tokens_dict):
+        temporary_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as tokens_file:
+            json.dump(tokens_dict, tokens_file)
+        os.replace(temporary_path, self.path)
+
+    def get(self, key, fetch_token):
+        # fetch_token returns (value, expires_in_seconds) or None; only one caller refreshes at a time
+        with self.locked():
+            tokens_dict = self.read_tokens()
+            entry = tokens_dict.get(key)
+            if entry and entry['expires_at'] - self.refresh_margin > time.time():
+                return entry['value']
+
+            fetched_token = fetch_token()
+            if not fetched_token:
+                return
+            value, expires_in = fetched_token
+            tokens_dict[key] = dict(value=value, expires_at=time.time() + expires_in)
+            self.write_tokens(tokens_dict)
+            return value
+
+    def invalidate(self, key):
+        with self.locked():
+            tokens_dict = self.read_tokens()
+            if tokens_dict.pop(key, None) is not None:
+                self.write_tokens(tokens_dict)
+
+
+token_cache = TokenCache()
@@ -0,0 +1,54 @@
+from datetime import datetime
+from enum import Enum
+
+
+class TracingStatus(Enum):
+    PENDING = 'Pending'
+    ON_ROUTE = 'On Route'
+    GROUNDING = 'Grounding'
+    GROUNDED = 'Grounded'
+    OUTGATED = 'Outgated'
+    UNKNOWN = 'Unknown'
+
+
+class TracingResult:
+    # Slotted so a 50k-container run holds small fixed records instead of a dict per container
+    __slots__ = ('container_number', 'current_status', 'timestamp', 'most_recent_event', 'scheduled_event',
+                 'eta', 'last_free_day')
+
+    def __init__(self, container_number, timestamp=None, current_status=TracingStatus.UNKNOWN,
+                 most_recent_event=None, scheduled_event=None, eta=None, last_free_day=None):
+        self.container_number = container_number
+        self.timestamp = timestamp
+        self.current_status = current_status
+        self.most_recent_event = most_recent_event
+        self.scheduled_event = scheduled_event
+        self.eta = eta
+        self.last_free_day = last_free_day
+
+    def update(self, fields=None, **kwargs):
+        # Carrier helpers return None when a field is missing from the response, which leaves the record as is
+        if fields:
+            for name, value in fields.items():
+                setattr(self, name, value)
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return 'TracingResult({})'.format(', '.join('{}={!r}'.format(name, getattr(self, name))
+                                                   for name in self.__slots__))
+
+    def to_dict(self):
+        # JSON-ready, for handing results from shard workers back to the coordinator
+        result_dict = {name: getattr(self, name) for name in self.__slots__}
+        result_dict['current_status'] = self.current_status.value
+        result_dict['timestamp'] = self.timestamp.isoformat() if self.timestamp else None
+        return result_dict
+
+    @staticmethod
+    def from_dict(result_dict):
+        result = TracingResult(**result_dict)
+        result.current_status = TracingStatus(result.current_status)
+        if result.timestamp:
+            result.timestamp = datetime.fromisoformat(result.timestamp)
+        return result
@@ -1,12 +1,181 @@
-from selenium import webdriver
+import atexit
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+import json
+import os
+import queue
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import run_metrics
+
+per_host_connection_limit = int(os.environ.get('PER_HOST_CONNECTION_LIMIT', 8))
+default_request_timeout = 60
+default_driver_path = '/Users/bryangalindo/PycharmProjects/raileggs_beta/raileggs/chromedriver'
+# Chrome content settings: 2 = block
+blocked_content_prefs = {
+    'profile.managed_default_content_settings.images': 2,
+    'profile.managed_default_content_settings.stylesheets': 2,
+    'profile.managed_default_content_settings.fonts': 2,
+}
 
 
 def has_digits(input_str):
     return any(char.isdigit() for char in input_str)
 
 
-def start_headless_driver():
+def get_carrier_from_yard(yard):
+    if 'CSX' in yard:
+        return 'CSX'
+    elif yard == 'NORFOLK SOUTHERN':
+        return 'NS'
+    return yard
+
+
+@lru_cache(maxsize=None)
+def get_data_sources(config_path='data_config.json'):
+    with open(config_path) as config_file:
+        return json.load(config_file)['data_sources']
+
+
+class HostLimitedAdapter(HTTPAdapter):
+    # Shared by every session in the process, so concurrent carriers can't flood one host
+    host_semaphores = defaultdict(lambda: threading.BoundedSemaphore(per_host_connection_limit))
+    host_semaphores_lock = threading.Lock()
+
+    def __init__(self, carrier='all', timeout=default_request_timeout, **kwargs):
+        self.carrier = carrier
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def get_host_semaphore(self, url):
+        with self.host_semaphores_lock:
+            return self.host_semaphores[urlsplit(url).netloc]
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        with self.get_host_semaphore(request.url):
+            started_at = time.perf_counter()
+            response = super().send(request, **kwargs)
+            if not kwargs.get('stream'):
+                # Read the body while holding the host slot so latency and size cover the whole response
+                run_metrics.add(self.carrier, 'bytes_received', len(response.content))
+            run_metrics.add(self.carrier, 'request_seconds', time.perf_counter() - started_at)
+        run_metrics.add(self.carrier, 'requests')
+        if response.status_code >= 400:
+            run_metrics.add(self.carrier, 'request_errors')
+        return response
+
+
+def create_session(carrier='all', pool_maxsize=per_host_connection_limit, timeout=default_request_timeout):
+    session = requests.Session()
+    adapter = HostLimitedAdapter(carrier=carrier, timeout=timeout, pool_maxsize=pool_maxsize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def start_headless_driver(driver_path=None, block_resources=False):
+    # Imported here so modules that never drive a browser don't pay for loading selenium
+    from selenium import webdriver
+
     options = webdriver.ChromeOptions()
     options.add_argument('headless')
-    driver_path = '/Users/bryangalindo/PycharmProjects/raileggs_beta/raileggs/chromedriver'
-    return webdriver.Chrome(executable_path=driver_path, options=options)
\ No newline at end of file
+    if block_resources:
+        options.add_argument('--blink-settings=imagesEnabled=false')
+        options.add_experimental_option('prefs', blocked_content_prefs)
+    driver_path = driver_path or os.environ.get('CHROMEDRIVER_PATH', default_driver_path)
+    return webdriver.Chrome(executable_path=driver_path, options=options)
+
+
+class DriverPool:
+    def __init__(self, size=2, driver_path=None, max_uses=20, block_resources=True):
+        self.size = size
+        self.driver_path = driver_path
+        self.max_uses = max_uses
+        self.block_resources = block_resources
+        self.idle_drivers = queue.LifoQueue()
+        self.uses_dict = {}
+        self.slots = threading.BoundedSemaphore(size)
+
+    def start_driver(self):
+        driver = start_headless_driver(self.driver_path, self.block_resources)
+        self.uses_dict[driver] = 0
+        return driver
+
+    def warm_up(self):
+        for _ in range(self.size - self.idle_drivers.qsize()):
+            self.idle_drivers.put(self.start_driver())
+
+    @staticmethod
+    def is_healthy(driver):
+        try:
+            driver.current_url
+            return True
+        except Exception:
+            return False
+
+    def discard(self, driver):
+        self.uses_dict.pop(driver, None)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    def checkout(self, timeout=None):
+        if not self.slots.acquire(timeout=timeout):
+            raise TimeoutError('No browser available after {} seconds'.format(timeout))
+        try:
+            while True:
+                try:
+                    driver = self.idle_drivers.get_nowait()
+                except queue.Empty:
+                    return self.start_driver()
+                if self.is_healthy(driver):
+                    return driver
+                self.discard(driver)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def checkin(self, driver):
+        try:
+            self.uses_dict[driver] = self.uses_dict.get(driver, 0) + 1
+            if self.uses_dict[driver] >= self.max_uses or not self.is_healthy(driver):
+                self.discard(driver)
+            else:
+                # delete_all_cookies() only covers the current page's domain, and CP logs in on a different one
+                # than it traces on; if clearing fails the driver is discarded rather than reused logged in
+                driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+                self.idle_drivers.put(driver)
+        except Exception:
+            self.discard(driver)
+        finally:
+            self.slots.release()
+
+    @contextmanager
+    def driver(self, timeout=None):
+        driver = self.checkout(timeout)
+        try:
+            yield driver
+        finally:
+            self.checkin(driver)
+
+    def close(self):
+        while not self.idle_drivers.empty():
+            self.discard(self.idle_drivers.get_nowait())
+
+
+@lru_cache(maxsize=None)
+def get_driver_pool():
+    driver_pool = DriverPool(size=int(os.environ.get('DRIVER_POOL_SIZE', 2)),
+                             max_uses=int(os.environ.get('DRIVER_MAX_USES', 20)))
+    # Otherwise headless Chrome outlives one-shot runs
+    atexit.register(driver_pool.close)
+    return driver_pool
@@ -0,0 +1,130 @@
+from datetime import datetime, timezone
+import sqlite3
+import threading
+import time
+
+from database import get_containers_sheet, get_view_entry, view_fields_dict
+from utilities import get_data_sources
+
+# Our own tracing writes touch every record, so only changes to the fields that decide view membership and
+# grouping count as modifications: the ones the snapshot stores plus the ones the view filters on. Deleted
+# records are picked up by the periodic full sync.
+default_watched_fields = ['Container', 'Container Yard', 'MBL', 'Final Destination']
+sync_overlap_seconds = 60
+
+
+def get_view_filter_fields(view_name):
+    # Airtable's API doesn't expose a view's filter, so the fields it reads are listed in data_config.json under
+    # airtable.view_filter_fields
+    filter_fields = get_data_sources()['airtable'].get('view_filter_fields', {}).get(view_name)
+    if filter_fields is None:
+        # Syncing without them would miss records joining or leaving the view, so refuse rather than guess
+        raise KeyError('airtable.view_filter_fields in data_config.json has no entry for {!r}, list the fields the '
+                       'view filters on or run with --full-sync'.format(view_name))
+    return filter_fields
+
+
+def get_modified_since_formula(since, watched_fields):
+    since_str = datetime.fromtimestamp(since, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    last_modified = 'LAST_MODIFIED_TIME({})'.format(', '.join('{{{}}}'.format(field) for field in watched_fields))
+    return "OR(IS_AFTER({}, DATETIME_PARSE('{}')), IS_AFTER(CREATED_TIME(), DATETIME_PARSE('{}')))".format(
+        last_modified, since_str, since_str)
+
+
+class ViewSnapshot:
+    def __init__(self, view_name, path='tracing_state.sqlite3', watched_fields=None, filter_fields=None,
+                 full_sync_after=24 * 60 * 60):
+        self.view_name = view_name
+        # Every sync is full with full_sync_after=0, which needs no filter fields
+        if filter_fields is None and full_sync_after:
+            filter_fields = get_view_filter_fields(view_name)
+        watched_fields = watched_fields or default_watched_fields
+        self.watched_fields = watched_fields + [field for field in filter_fields or [] if field not in watched_fields]
+        self.full_sync_after = full_sync_after
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS view_snapshot ('
+                                'view_name TEXT NOT NULL, '
+                                'record_id TEXT NOT NULL, '
+                                'container TEXT NOT NULL, '
+                                'group_key TEXT NOT NULL, '
+                                'mbl TEXT, '
+                                'final_destination TEXT, '
+                                'PRIMARY KEY (view_name, record_id))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS view_sync ('
+                                'view_name TEXT PRIMARY KEY, '
+                                'synced_at REAL NOT NULL, '
+                                'full_synced_at REAL NOT NULL)')
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(view_snapshot)')]
+        if 'final_destination' not in columns:
+            # Snapshots from before Final Destination was stored are refilled by a full sync
+            self.connection.execute('ALTER TABLE view_snapshot ADD COLUMN final_destination TEXT')
+            self.connection.execute('DELETE FROM view_sync')
+        self.connection.commit()
+
+    def get_sync_times(self):
+        with self.lock:
+            row = self.connection.execute('SELECT synced_at, full_synced_at FROM view_sync WHERE view_name = ?',
+                                          (self.view_name,)).fetchone()
+        return row or (None, None)
+
+    def get_view_entries(self):
+        with self.lock:
+            return self.connection.execute('SELECT container, group_key, mbl FROM view_snapshot WHERE view_name = ? '
+                                           'ORDER BY rowid', (self.view_name,)).fetchall()
+
+    def get_records_dict(self):
+        # {container: (record id, final destination)}, what the load stage would otherwise load the whole table for
+        with self.lock:
+            rows = self.connection.execute('SELECT container, record_id, final_destination FROM view_snapshot '
+                                           'WHERE view_name = ? ORDER BY rowid', (self.view_name,)).fetchall()
+        return {container: (record_id, final_destination) for container, record_id, final_destination in rows}
+
+    def get_entry_rows(self, airtable_records):
+        rows = []
+        for record in airtable_records:
+            view_entry = get_view_entry(self.view_name, record['fields'])
+            if view_entry:
+                final_destination = record['fields'].get('Final Destination') or [None]
+                rows.append((self.view_name, record['id']) + view_entry + (final_destination[0],))
+        return rows
+
+    def full_sync(self, started_at):
+        airtable_records = get_containers_sheet().get_all(fields=view_fields_dict[self.view_name],
+                                                          view=self.view_name)
+        with self.lock:
+            self.connection.execute('DELETE FROM view_snapshot WHERE view_name = ?', (self.view_name,))
+            self.connection.executemany('INSERT INTO view_snapshot VALUES (?, ?, ?, ?, ?, ?)',
+                                        self.get_entry_rows(airtable_records))
+            self.connection.execute('INSERT OR REPLACE INTO view_sync VALUES (?, ?, ?)',
+                                    (self.view_name, started_at, started_at))
+            self.connection.commit()
+
+    def incremental_sync(self, started_at, synced_at, full_synced_at):
+        # The same formula with and without the view: records changed outside the view have left it
+        formula = get_modified_since_formula(synced_at - sync_overlap_seconds, self.watched_fields)
+        changed_in_view_records = get_containers_sheet().get_all(fields=view_fields_dict[self.view_name],
+                                                                 view=self.view_name, formula=formula)
+        changed_records = get_containers_sheet().get_all(fields=['Container'], formula=formula)
+
+        entry_rows = self.get_entry_rows(changed_in_view_records)
+        kept_record_ids = {row[1] for row in entry_rows}
+        removed_record_ids = [record['id'] for record in changed_in_view_records + changed_records
+                              if record['id'] not in kept_record_ids]
+        with self.lock:
+            self.connection.executemany('DELETE FROM view_snapshot WHERE view_name = ? AND record_id = ?',
+                                        [(self.view_name, record_id) for record_id in removed_record_ids])
+            self.connection.executemany('INSERT OR REPLACE INTO view_snapshot VALUES (?, ?, ?, ?, ?, ?)', entry_rows)
+            self.connection.execute('INSERT OR REPLACE INTO view_sync VALUES (?, ?, ?)',
+                                    (self.view_name, started_at, full_synced_at))
+            self.connection.commit()
+
+    def sync(self, force_full=False):
+        started_at = time.time()
+        synced_at, full_synced_at = self.get_sync_times()
+        if force_full or synced_at is None or \
+                started_at - full_synced_at > self.full_sync_after:
+            self.full_sync(started_at)
+        else:
+            self.incremental_sync(started_at, synced_at, full_synced_at)
+        return self.get_view_entries()